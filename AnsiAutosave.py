@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+import time
+
+class AnsiAutosave:
+    """
+    Saves an AnsiImage to a rotating set of files every so many edit steps or seconds.
+
+    The editing side only takes a snapshot of the cells. Writing it as .ans happens on a
+    background thread, into a temporary file that is then renamed over the autosave, so
+    autosaves are always complete files. Snapshots with the same contents as the last
+    written one are not written again.
+    """
+    def __init__(self, directory = "autosaves", steps = 10, interval = 60.0, max_files = 25):
+        """
+        Saves once steps edit steps happened, or at least one did and interval seconds
+        went by since the last save, cycling through max_files + 1 files in directory
+        """
+        self.directory = directory
+        self.steps = steps
+        self.interval = interval
+        self.max_files = max_files
+
+        self.steps_since_save = 0
+        self.last_save_time = time.monotonic()
+        self.counter = 0
+
+        # Newest snapshot waiting to be written, written contents, and whether the writer runs
+        self.lock = threading.Lock()
+        self.pending = None
+        self.last_digest = None
+        self.writing = False
+        self.writer = None
+
+        # Latency of the last save, in seconds: Taking the snapshot, and writing it
+        self.snapshot_time = 0.0
+        self.write_time = 0.0
+        self.last_path = None
+
+        # What went wrong with the last write, if anything
+        self.last_error = None
+
+    def reset(self):
+        """
+        Start counting steps and time anew, e.g. after loading a file
+        """
+        self.steps_since_save = 0
+        self.last_save_time = time.monotonic()
+
+    def step(self, image):
+        """
+        Call when an edit step is done or undone. Snapshots the image and has it
+        written in the background if an autosave is due.
+
+        Returns True if an autosave was started, False if no
+        """
+        self.steps_since_save += 1
+        elapsed = time.monotonic() - self.last_save_time
+        if self.steps_since_save < self.steps and elapsed < self.interval:
+            return False
+
+        snapshot_start = time.perf_counter()
+        snapshot = image.snapshot()
+        self.snapshot_time = time.perf_counter() - snapshot_start
+
+        self.steps_since_save = 0
+        self.last_save_time = time.monotonic()
+        with self.lock:
+            self.pending = snapshot
+            if self.writing == True:
+                return True
+            self.writing = True
+            self.writer = threading.Thread(target = self.write_pending, daemon = True)
+            self.writer.start()
+        return True
+
+    def write_pending(self):
+        """
+        Writes snapshots until none are left. Runs on the background thread.
+
+        Errors writing a snapshot are kept in last_error, and the writer carries on with the
+        next one, so a failed write doesn't stop autosaving.
+        """
+        finished = False
+        try:
+            while True:
+                with self.lock:
+                    snapshot = self.pending
+                    self.pending = None
+                    if snapshot is None:
+                        self.writing = False
+                        finished = True
+                        return
+                try:
+                    self.write(snapshot)
+                    self.last_error = None
+                except Exception as error:
+                    self.last_error = error
+        finally:
+            # Whatever happened, the next step has to be able to start a writer again
+            if finished == False:
+                with self.lock:
+                    self.writing = False
+
+    def write(self, snapshot):
+        """
+        Writes a snapshot to the next autosave file, unless nothing changed since the last one
+        """
+        write_start = time.perf_counter()
+        digest = hashlib.blake2b(snapshot.ansi_image.tobytes(), digest_size = 16)
+        digest.update(str(snapshot.get_size()).encode("ascii"))
+        digest = digest.digest()
+        if digest == self.last_digest:
+            return
+
+        os.makedirs(self.directory, exist_ok = True)
+        self.counter += 1
+        if self.counter > self.max_files:
+            self.counter = 0
+        save_path = os.path.join(self.directory, "autosave_{0}.ans".format(self.counter))
+        temp_path = save_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                snapshot.write_ans(f)
+            os.replace(temp_path, save_path)
+        except:
+            # Don't leave half written files lying around
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            raise
+
+        self.last_digest = digest
+        self.last_path = save_path
+        self.write_time = time.perf_counter() - write_start
+
+    def wait(self, timeout = None):
+        """
+        Waits until everything is written. Returns True if so, False if the timeout ran out
+        """
+        wait_until = None if timeout == None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if self.writing == False:
+                    return True
+            if wait_until != None and time.monotonic() > wait_until:
+                return False
+            time.sleep(0.01)
+
+    def close(self, timeout = None):
+        """
+        Writes whatever is still queued and waits for the writer thread to finish. Call before
+        exiting, the writer is a daemon thread and would otherwise be killed mid-queue.
+
+        Returns True if everything was written, False if the timeout ran out
+        """
+        with self.lock:
+            writer = self.writer
+        if writer == None:
+            return True
+        writer.join(timeout)
+        return writer.is_alive() == False
@@ -0,0 +1,178 @@
+import numpy as np
+
+class AnsiDelta:
+    """
+    A change to an AnsiImage, stored compactly: An optional new size, and then values to
+    write into cells, either as rectangular blocks or as lists of scattered cells.
+
+    Values are int16 [char, fore, back] triplets, with -1 for channels that are left as
+    they are. Applying a delta returns the delta that reverses it, which is what undo
+    history is made of.
+    """
+    # Rough per-part bookkeeping cost, for memory accounting
+    PART_OVERHEAD = 128
+
+    def __init__(self, size = None):
+        """
+        Creates an empty delta, optionally one that changes the image size to a
+        (width, height) tuple before writing anything
+        """
+        self.size = size
+
+        # ("rect", x, y, values (h, w, 3)) or ("cells", cell x, cell y, values (n, 3)), applied in order
+        self.parts = []
+
+    @staticmethod
+    def difference(x, y, current, target):
+        """
+        Creates a delta that turns a block of cells with its top left corner at x, y from the
+        current into the target values, holding only the cells that differ
+        """
+        delta = AnsiDelta()
+        # Per channel, reducing over the short last axis is a lot slower
+        changed = current[..., 0] != target[..., 0]
+        changed |= current[..., 1] != target[..., 1]
+        changed |= current[..., 2] != target[..., 2]
+        rows = np.flatnonzero(changed.any(axis = 1))
+        if len(rows) == 0:
+            return delta
+        
+        start_y, end_y = rows[0], rows[-1] + 1
+        columns = np.flatnonzero(changed[start_y:end_y].any(axis = 0))
+        start_x, end_x = columns[0], columns[-1] + 1
+        values = target[start_y:end_y, start_x:end_x].astype(np.int16)
+        values[~changed[start_y:end_y, start_x:end_x]] = -1
+        delta.add_rect(x + int(start_x), y + int(start_y), values)
+        return delta
+
+    def add_rect(self, x, y, values):
+        """
+        Adds a block of values to write with its top left corner at x, y
+        """
+        values = np.asarray(values, dtype=np.int16)
+        if values.size != 0:
+            self.parts.append(("rect", x, y, values))
+
+    def add_cells(self, cell_x, cell_y, values):
+        """
+        Adds values to write to a list of distinct cells. Cells that exactly fill a
+        rectangle are stored as a block.
+        """
+        cell_x = np.asarray(cell_x, dtype=np.int32)
+        cell_y = np.asarray(cell_y, dtype=np.int32)
+        values = np.asarray(values, dtype=np.int16)
+        if len(cell_x) == 0:
+            return
+
+        start_x, start_y = int(cell_x.min()), int(cell_y.min())
+        width, height = int(cell_x.max()) + 1 - start_x, int(cell_y.max()) + 1 - start_y
+        if width * height == len(cell_x):
+            block = np.empty((height, width, 3), dtype=np.int16)
+            block[cell_y - start_y, cell_x - start_x] = values
+            self.parts.append(("rect", start_x, start_y, block))
+        else:
+            self.parts.append(("cells", cell_x, cell_y, values))
+
+    def is_empty(self):
+        """
+        True if applying this delta does nothing
+        """
+        return self.size == None and len(self.parts) == 0
+
+    def nbytes(self):
+        """
+        Returns roughly how much memory this delta takes up
+        """
+        total = AnsiDelta.PART_OVERHEAD
+        for part in self.parts:
+            total += AnsiDelta.PART_OVERHEAD + part[3].nbytes
+            if part[0] == "cells":
+                total += part[1].nbytes + part[2].nbytes
+        return total
+
+    def then(self, other):
+        """
+        Returns a delta that applies this delta, then the other one, which must not
+        change the image size
+        """
+        if other.size != None:
+            raise ValueError("Can only append deltas that keep the image size")
+
+        combined = AnsiDelta(self.size)
+        combined.parts = list(self.parts)
+        for part in other.parts:
+            # Merge lists of cells as long as they don't overlap, to keep the part count down
+            if part[0] == "cells" and len(combined.parts) != 0 and combined.parts[-1][0] == "cells":
+                _, cell_x, cell_y, values = combined.parts[-1]
+                _, other_x, other_y, other_values = part
+                if not np.any(np.isin(cell_y.astype(np.int64) << 32 | cell_x, other_y.astype(np.int64) << 32 | other_x)):
+                    combined.parts[-1] = (
+                        "cells",
+                        np.concatenate((cell_x, other_x)),
+                        np.concatenate((cell_y, other_y)),
+                        np.concatenate((values, other_values))
+                    )
+                    continue
+            combined.parts.append(part)
+        return combined
+
+    def apply(self, image):
+        """
+        Applies this delta to an AnsiImage
+
+        Returns the delta that reverses it
+        """
+        inverse = AnsiDelta()
+        if self.size != None:
+            old_width, old_height = image.get_size()
+            new_width, new_height = self.size
+            inverse.size = (old_width, old_height)
+
+            # Keep only what gets cropped away: The part right of the new width and below the new height
+            if new_width < old_width:
+                inverse.add_rect(new_width, 0, image.ansi_image[:, new_width:])
+            if new_height < old_height:
+                inverse.add_rect(0, new_height, image.ansi_image[new_height:, :min(old_width, new_width)])
+            image.change_size(new_width, new_height)
+
+        # Previous values of written cells, for the inverse, which has to write them in reverse order
+        restore = []
+        for part in self.parts:
+            if part[0] == "rect":
+                _, x, y, values = part
+
+                # Clip to the image
+                values = values[max(0, -y):max(0, image.height - y), max(0, -x):max(0, image.width - x)]
+                x, y = max(0, x), max(0, y)
+                if values.size == 0:
+                    continue
+
+                region = image.ansi_image[y:y + values.shape[0], x:x + values.shape[1]]
+                previous = region.astype(np.int16)
+                if np.all(values >= 0):
+                    region[:] = values
+                else:
+                    region[:] = np.where(values >= 0, values, previous)
+                    previous[values < 0] = -1
+                restore.append(("rect", x, y, previous))
+                image.mark_redraw(x, y, x + values.shape[1], y + values.shape[0])
+            else:
+                _, cell_x, cell_y, values = part
+
+                in_image = (cell_x >= 0) & (cell_y >= 0) & (cell_x < image.width) & (cell_y < image.height)
+                cell_x, cell_y, values = cell_x[in_image], cell_y[in_image], values[in_image]
+                if len(cell_x) == 0:
+                    continue
+
+                previous = image.ansi_image[cell_y, cell_x].astype(np.int16)
+                for channel in range(3):
+                    write = values[:, channel] >= 0
+                    image.ansi_image[cell_y[write], cell_x[write], channel] = values[write, channel]
+                previous[values < 0] = -1
+                restore.append(("cells", cell_x, cell_y, previous))
+                image.mark_redraw_cells(cell_x, cell_y)
+
+        inverse.parts.extend(reversed(restore))
+        if not inverse.is_empty():
+            image.is_dirty = True
+        return inverse
@@ -1,5 +1,12 @@
 import numpy as np
-import PIL
+import PIL.Image
+import atexit
+import collections
+import hashlib
+import json
+import multiprocessing.shared_memory
+import os
+import time
 
 class AnsiGraphics:
     """
@@ -26,70 +33,259 @@ class AnsiGraphics:
         np.array([255, 255, 255]) / 255.0
     ];
     
-    def __init__(self, font_file, char_size_x = 8, char_size_y = 16):
+    # Same palette, as opaque 8 bit RGBA, for the renderer
+    CGA_PAL_RGBA = np.concatenate([
+        np.round(np.array(CGA_PAL) * 255.0),
+        np.full((16, 1), 255.0)
+    ], axis = 1).astype(np.uint8)
+    
+    # Bump when the compiled font format changes
+    COMPILED_FONT_VERSION = 1
+    
+    # Written into shared rendering tables once they are complete, see publish_shared
+    SHARED_READY = 0x45534e48
+    
+    # Size of the header of shared rendering tables: ready marker, char size x, char size y, unused
+    SHARED_HEADER_SIZE = 16
+    
+    # How many coloured characters coloured_char keeps around
+    COLOUR_CHAR_CACHE_SIZE = 1024
+    
+    def __init__(self, font_file, char_size_x = 8, char_size_y = 16, cache_dir = None):
         """
         Reads the font to use and prepares it for usage.
-        Fonts are files with a sequence of bits specifying 8x16 characters.
+        Fonts are files with a sequence of bits specifying 8x16 characters,
+        or images with 16x16 characters.
+        
+        Decoded fonts are cached in cache_dir (default: "cache" next to the font file).
         """
         # Character sizes
         self.char_size_x = char_size_x
         self.char_size_y = char_size_y
         
+        # All glyphs as one boolean atlas, coloured at render time using the palette
+        self.glyph_masks = AnsiGraphics.load_font(font_file, char_size_x, char_size_y, cache_dir)
+        
+        # Recently used coloured characters, built on demand by coloured_char
+        self.colour_chars = collections.OrderedDict()
+        
+        # Glyph coverage at low resolutions, built on demand by glyph_coverage
+        self.glyph_coverages = {}
+    
+    @staticmethod
+    def decode_font(font_file, char_size_x, char_size_y):
+        """
+        Decodes a font file into a (256, char_size_y, char_size_x) boolean glyph atlas.
+        """
+        glyph_bits = 256 * char_size_y * char_size_x
         if font_file.endswith(".fnt"):
-            # Read the font
-            f = open(font_file, "rb")
-            in_bits = []
-            try:
-                byte = f.read(1)
-                while len(byte) != 0:
-                    bin_str = bin(int.from_bytes(byte, 'little'))[2:]
-                    for bit in bin_str.zfill(8):
-                        in_bits.append(bit)
-                    byte = f.read(1)
-            finally:
-                f.close()
-            
-            # Split into chars
-            self.font_chars = []
-            for i in range(0, 256):
-                char_bits = np.array(in_bits[i * self.char_size_y * self.char_size_x : (i + 1) * self.char_size_y * self.char_size_x])
-                char_bits = char_bits.reshape(self.char_size_y, self.char_size_x).astype(float)
-                self.font_chars.append(char_bits)
+            font_bits = np.unpackbits(np.fromfile(font_file, dtype=np.uint8))
+            if len(font_bits) < glyph_bits:
+                raise ValueError("Font must have 256 characters.")
+            return font_bits[:glyph_bits].reshape(256, char_size_y, char_size_x) == 1
         else:
             font_pic = PIL.Image.open(font_file).convert('RGB')
-            font_arr = np.array(font_pic)
-            font_arr = font_arr[:,:,0]
-            font_arr[font_arr != 0] = 1
+            font_arr = np.array(font_pic)[:, :, 0] != 0
             
-            image_rows = font_pic.width // char_size_x
-            image_cols = font_pic.height // char_size_y
+            image_rows = font_pic.height // char_size_y
+            image_cols = font_pic.width // char_size_x
             
             if image_rows * image_cols != 256:
                 raise ValueError("Font must have 256 characters.")
             
-            self.font_chars = []
-            for row in range(image_rows):
-                for col in range(image_cols):
-                    self.font_chars.append(font_arr[
-                        row * self.char_size_y : (row + 1) * self.char_size_y,
-                        col * self.char_size_x : (col + 1) * self.char_size_x
-                    ])
+            # Cut the picture into cells, row by row
+            font_arr = font_arr[:image_rows * char_size_y, :image_cols * char_size_x]
+            font_arr = font_arr.reshape(image_rows, char_size_y, image_cols, char_size_x)
+            return font_arr.transpose(0, 2, 1, 3).reshape(256, char_size_y, char_size_x)
+    
+    @staticmethod
+    def font_key(font_file, char_size_x, char_size_y):
+        """
+        Returns a name identifying a font by its files contents and character size,
+        so that changed fonts never pick up stale compiled versions.
+        """
+        with open(font_file, "rb") as f:
+            font_hash = hashlib.sha1(f.read()).hexdigest()
+        
+        return "font_v{0}_{1}_{2}x{3}".format(
+            AnsiGraphics.COMPILED_FONT_VERSION,
+            font_hash, 
+            char_size_x, 
+            char_size_y
+        )
+    
+    @staticmethod
+    def compiled_font_path(font_file, char_size_x, char_size_y, cache_dir = None):
+        """
+        Returns where the compiled version of a font is cached.
+        """
+        if cache_dir == None:
+            cache_dir = os.path.join(os.path.dirname(font_file), "cache")
+        return os.path.join(cache_dir, AnsiGraphics.font_key(font_file, char_size_x, char_size_y) + ".npy")
+    
+    @staticmethod
+    def load_font(font_file, char_size_x, char_size_y, cache_dir = None):
+        """
+        Loads a fonts glyph atlas, memory-mapped from the compiled font cache if possible.
+        Fonts that are not in the cache yet are decoded and then added to it.
+        """
+        compiled_path = AnsiGraphics.compiled_font_path(font_file, char_size_x, char_size_y, cache_dir)
+        if os.path.exists(compiled_path):
+            return np.load(compiled_path, mmap_mode = 'r')
+        
+        glyph_masks = AnsiGraphics.decode_font(font_file, char_size_x, char_size_y)
+        
+        # Caching is optional - a read-only config directory is fine
+        try:
+            os.makedirs(os.path.dirname(compiled_path), exist_ok = True)
+            temp_path = compiled_path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, "wb") as f:
+                np.save(f, glyph_masks)
+            os.replace(temp_path, compiled_path)
+        except OSError:
+            pass
+        return glyph_masks
+    
+    @staticmethod
+    def compile_fonts(config_dir = "config", cache_dir = None):
+        """
+        Compiles every font listed in the fonts.json in config_dir into the font cache.
+        """
+        with open(os.path.join(config_dir, "fonts.json"), "r") as f:
+            fonts = json.load(f)
+        
+        for font in fonts:
+            font_file = os.path.join(config_dir, font["file"])
+            compiled_path = AnsiGraphics.compiled_font_path(font_file, font["width"], font["height"], cache_dir)
+            if os.path.exists(compiled_path):
+                os.remove(compiled_path)
+            AnsiGraphics.load_font(font_file, font["width"], font["height"], cache_dir)
             
-        # It's 2018 and memory is cheap, so lets precompute every possible fore/back/char combination
-        self.colour_chars = []
-        for char_idx in range(0, 256):
-            fg_chars = []
-            for fg_idx in range(0, 16):
-                bg_chars = []
-                for bg_idx in range(0, 16):
-                    char_base = self.font_chars[char_idx][:]
-                    char_col = np.zeros((char_base.shape[0], char_base.shape[1], 3))
-                    char_col[np.where(char_base == 1)] = AnsiGraphics.CGA_PAL[fg_idx]
-                    char_col[np.where(char_base == 0)] = AnsiGraphics.CGA_PAL[bg_idx]
-                    bg_chars.append(char_col)
-                fg_chars.append(bg_chars)
-            self.colour_chars.append(fg_chars)
-      
+    @staticmethod
+    def from_glyph_masks(glyph_masks):
+        """
+        Creates graphics directly from an existing (256, char_size_y, char_size_x) glyph atlas.
+        The atlas is used as is, not copied.
+        """
+        graphics = AnsiGraphics.__new__(AnsiGraphics)
+        graphics.char_size_y, graphics.char_size_x = glyph_masks.shape[1:]
+        graphics.glyph_masks = glyph_masks
+        graphics.colour_chars = collections.OrderedDict()
+        graphics.glyph_coverages = {}
+        return graphics
+    
+    def publish_shared(self, name):
+        """
+        Copies the rendering tables into a new named shared memory block, so that
+        other processes can use them via attach_shared without loading the font.
+        
+        The block exists before it is filled, so the header only gets its ready marker
+        once everything else has been written.
+        """
+        shared_memory = multiprocessing.shared_memory.SharedMemory(
+            name = name, 
+            create = True, 
+            size = AnsiGraphics.SHARED_HEADER_SIZE + self.glyph_masks.nbytes
+        )
+        header = np.ndarray(4, dtype=np.uint32, buffer=shared_memory.buf)
+        header[1:] = (self.char_size_x, self.char_size_y, 0)
+        shared_masks = np.ndarray(self.glyph_masks.shape, dtype=bool, buffer=shared_memory.buf, offset=AnsiGraphics.SHARED_HEADER_SIZE)
+        shared_masks[:] = self.glyph_masks
+        shared_masks.flags.writeable = False
+        header[0] = AnsiGraphics.SHARED_READY
+        
+        # The block has to stay mapped for as long as we use it, and its name goes away with us
+        self.shared_memory = shared_memory
+        atexit.register(AnsiGraphics.unlink_shared, shared_memory, os.getpid())
+        self.glyph_masks = shared_masks
+    
+    @staticmethod
+    def unlink_shared(shared_memory, publisher_pid):
+        """
+        Removes the name of a published shared memory block, but only in the process that 
+        published it - processes forked afterwards inherit the exit handler, and must not 
+        take the name away from everyone else when they exit.
+        """
+        if os.getpid() != publisher_pid:
+            return
+        try:
+            shared_memory.unlink()
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def attach_shared(name, timeout = 2.0):
+        """
+        Creates graphics that use the read-only rendering tables published under the given name,
+        waiting up to timeout seconds for them to be completely written.
+        
+        Raises FileNotFoundError if nothing was published under that name, and ValueError if
+        what was published didn't become ready in time or doesn't look like rendering tables.
+        """
+        try:
+            shared_memory = multiprocessing.shared_memory.SharedMemory(name = name, track = False)
+        except TypeError:
+            # Before Python 3.13 attaching can't opt out of the resource tracker, which then also
+            # counts the block as ours. Publish from the longest running process so that doesn't matter.
+            shared_memory = multiprocessing.shared_memory.SharedMemory(name = name)
+        
+        header = None
+        try:
+            if shared_memory.size < AnsiGraphics.SHARED_HEADER_SIZE:
+                raise ValueError("Shared rendering tables are too small")
+            header = np.ndarray(4, dtype=np.uint32, buffer=shared_memory.buf)
+            wait_until = time.monotonic() + timeout
+            while header[0] != AnsiGraphics.SHARED_READY:
+                if time.monotonic() > wait_until:
+                    raise ValueError("Shared rendering tables did not become ready")
+                time.sleep(0.01)
+            
+            char_size_x, char_size_y = int(header[1]), int(header[2])
+            if char_size_x == 0 or char_size_y == 0 or shared_memory.size < AnsiGraphics.SHARED_HEADER_SIZE + 256 * char_size_x * char_size_y:
+                raise ValueError("Shared rendering tables have a bad size")
+        except (FileNotFoundError, ValueError):
+            # The mapping can only be closed once nothing looks at it anymore
+            header = None
+            shared_memory.close()
+            raise
+        header = None
+        
+        shared_masks = np.ndarray((256, char_size_y, char_size_x), dtype=bool, buffer=shared_memory.buf, offset=AnsiGraphics.SHARED_HEADER_SIZE)
+        shared_masks.flags.writeable = False
+        
+        graphics = AnsiGraphics.from_glyph_masks(shared_masks)
+        graphics.shared_memory = shared_memory
+        return graphics
+    
+    @staticmethod
+    def shared(font_file, char_size_x = 8, char_size_y = 16, cache_dir = None):
+        """
+        Loads a font once per machine: Attaches to the fonts rendering tables if another 
+        process has already published them, otherwise loads the font and publishes them.
+        """
+        # Short names, since some platforms limit the length of shared memory names
+        font_key = AnsiGraphics.font_key(font_file, char_size_x, char_size_y)
+        name = "hanse_" + hashlib.sha1(font_key.encode("utf-8")).hexdigest()[:16]
+        
+        try:
+            return AnsiGraphics.attach_shared(name)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # Published but never finished, e.g. by a process that died while doing it
+            return AnsiGraphics(font_file, char_size_x, char_size_y, cache_dir)
+        
+        graphics = AnsiGraphics(font_file, char_size_x, char_size_y, cache_dir)
+        try:
+            graphics.publish_shared(name)
+        except FileExistsError:
+            # Someone else was faster
+            try:
+                return AnsiGraphics.attach_shared(name)
+            except (FileNotFoundError, ValueError):
+                pass
+        return graphics
+    
     def get_char_size(self):
         """
         Return the character size, in pixels
@@ -106,11 +302,68 @@ class AnsiGraphics:
         """
         Returns the font character with the given index as a binary bitmap.
         """
-        return self.font_chars[idx]
+        return self.glyph_masks[char_idx].astype(float)
     
     def coloured_char(self, char_idx, fg_idx, bg_idx):
         """
         Returns the font character with the given index and given fore and back colours as an RGP bitmap.
         """
-        return self.colour_chars[char_idx][fg_idx][bg_idx]
+        key = (char_idx, fg_idx, bg_idx)
+        if key in self.colour_chars:
+            self.colour_chars.move_to_end(key)
+            return self.colour_chars[key]
+        
+        colour_char = np.where(
+            self.glyph_masks[char_idx][..., np.newaxis],
+            AnsiGraphics.CGA_PAL[fg_idx],
+            AnsiGraphics.CGA_PAL[bg_idx]
+        )
+        self.colour_chars[key] = colour_char
+        if len(self.colour_chars) > AnsiGraphics.COLOUR_CHAR_CACHE_SIZE:
+            self.colour_chars.popitem(last = False)
+        return colour_char
+    
+    def render_cells(self, cells):
+        """
+        Renders an array of cells (last axis: char idx, fg pal idx, bg pal idx) in one go.
+        
+        Returns an uint8 RGBA array of shape cells.shape[:-1] + (char height, char width, 4).
+        """
+        # Pick whole pixels at a time by viewing RGBA quadruplets as 32 bit values
+        palette = AnsiGraphics.CGA_PAL_RGBA.view(np.uint32)[:, 0]
+        glyphs = self.glyph_masks[cells[..., 0]]
+        fore = palette[cells[..., 1]][..., np.newaxis, np.newaxis]
+        back = palette[cells[..., 2]][..., np.newaxis, np.newaxis]
+        pixels = np.where(glyphs, fore, back)
+        return pixels.view(np.uint8).reshape(pixels.shape + (4,))
     
+    def glyph_coverage(self, size_x, size_y):
+        """
+        Returns how much of each part of each glyph is set, with glyphs box-filtered down to
+        size_x by size_y pixels, as a (256, size_y, size_x) float32 array of fractions.
+        """
+        key = (size_x, size_y)
+        if not key in self.glyph_coverages:
+            edges_x = (np.arange(size_x) * self.char_size_x) // size_x
+            edges_y = (np.arange(size_y) * self.char_size_y) // size_y
+            set_pixels = np.add.reduceat(self.glyph_masks.astype(np.float32), edges_y, axis = 1)
+            set_pixels = np.add.reduceat(set_pixels, edges_x, axis = 2)
+            
+            areas = np.outer(np.diff(edges_y, append = self.char_size_y), np.diff(edges_x, append = self.char_size_x))
+            self.glyph_coverages[key] = set_pixels / areas
+        return self.glyph_coverages[key]
+    
+    def render_cells_coverage(self, cells, size_x, size_y):
+        """
+        Renders an array of cells (last axis: char idx, fg pal idx, bg pal idx) at low resolution,
+        size_x by size_y pixels per cell, mixing fore and back colours by glyph coverage.
+        
+        Returns an uint8 RGBA array of shape cells.shape[:-1] + (size_y, size_x, 4).
+        """
+        coverage = self.glyph_coverage(size_x, size_y)[cells[..., 0]][..., np.newaxis]
+        fore = AnsiGraphics.CGA_PAL_RGBA[cells[..., 1]][..., np.newaxis, np.newaxis, :].astype(np.float32)
+        back = AnsiGraphics.CGA_PAL_RGBA[cells[..., 2]][..., np.newaxis, np.newaxis, :].astype(np.float32)
+        return np.round(back + (fore - back) * coverage).astype(np.uint8)
+
+if __name__ == "__main__":
+    AnsiGraphics.compile_fonts()
@@ -1,45 +1,96 @@
 import numpy as np
 from PIL import Image
-import copy
-import time
-import os
+import collections
+import itertools
+import io
+import html
+import re
+
+from AnsiParser import AnsiParser
+from AnsiDelta import AnsiDelta
+from AnsiTransform import AnsiTransform
+from AnsiSauce import AnsiSauce
+from AnsiAutosave import AnsiAutosave
 
 class AnsiImage:
     """
     Manages a rectangular image made of ansi character cells
     """
-    def __init__(self, graphics, min_line_len = None, has_autosave=False):
+    # Escapes for colour changes, by (fore, back, new fore, new back)
+    SGR_CHANGES = {}
+    
+    # Runs of spaces that are shorter as a cursor forward move
+    SPACE_RUN = re.compile(b" {5,}")
+    
+    # Characters as HTML, by code point, with control characters shown as spaces
+    HTML_CHARS = {char: " " if char < 32 else html.escape(chr(char)) for char in range(256)}
+    
+    # Span start tags, by fore * 16 + back
+    HTML_SPANS = ['<span class="fg' + str(colour // 16) + ' bg' + str(colour % 16) + '">' for colour in range(256)]
+    
+    # How much of a file to read at a time when loading
+    LOAD_CHUNK_SIZE = 64 * 1024
+    
+    # Size of the render cache tiles, in cells
+    TILE_SIZE = 64
+    
+    # Default render cache memory budget, in bytes
+    RENDER_CACHE_BUDGET = 128 * 1024 * 1024
+    
+    # About how many cells to build the minimap from at a time
+    MINIMAP_CHUNK_CELLS = 16 * 1024
+    
+    # Changes to more cells than this get redrawn as their bounding rectangle
+    REDRAW_CELLS_MAX = 4096
+    
+    def __init__(self, graphics, min_line_len = None, has_autosave=False, render_cache_budget = None):
         """
         Optionally allows the specification of a minimum
-        line length, used when loading
+        line length, used when loading, and of how much memory 
+        cached rendered tiles may use
         """
         self.min_line_len = min_line_len
-        self.ansi_image = []
+        self.ansi_image = np.zeros((0, 0, 3), dtype=np.uint8)
         self.width = 0
         self.height = 0
         self.cursor_x = 0
         self.cursor_y = 0
         self.is_dirty = False
         self.write_allowed = [True, True, True]
-        self.steps_since_autosave = 0
-        self.autosave_steps = 10
-        self.autosave_counter = 0
-        self.autosave_max = 25
         self.has_autosave = has_autosave
+        self.autosave = AnsiAutosave() if has_autosave else None
+        
+        # SAUCE metadata of the loaded file, if it had any
+        self.sauce = None
         
         self.ansi_graphics = graphics
         self.char_size_x = self.ansi_graphics.get_char_size()[0]
         self.char_size_y = self.ansi_graphics.get_char_size()[1]
         
-        # Selection related stuff
+        # Selection related stuff: Boolean (height, width) cell masks, or None
         self.selection = None
-        self.selection_preliminary = set()
-        self.selection_preliminary_remove = set()
+        self.selection_preliminary = None
+        self.selection_preliminary_remove = None
         self.redraw_set = set()
-        self.ansi_bitmap = None
+        self.redraw_areas = []
         self.have_cache = False
+        
+        # Cells that the minimap has already redrawn, but the render cache hasn't yet
+        self.minimap_redrawn_set = set()
+        self.minimap_redrawn_areas = []
         self.cache_params = None
         
+        # Rendered tiles, least recently used first
+        self.render_tiles = collections.OrderedDict()
+        self.render_tiles_size = 0
+        self.render_cache_budget = render_cache_budget if render_cache_budget != None else AnsiImage.RENDER_CACHE_BUDGET
+        
+        # Low resolution overview, see to_minimap, and the cells and graphics it was made from
+        self.minimap = None
+        self.minimap_params = None
+        self.minimap_source = None
+        self.minimap_changes = None
+        
         # The cursor
         self.rebuild_cursor()
         
@@ -50,14 +101,12 @@ class AnsiImage:
         return (self.width, self.height)
     
     def rebuild_cursor(self):
-        self.cursor_shape = []
-        for y in [0, 1, self.char_size_y - 2, self.char_size_y - 1]:
-            for x in range(0, self.char_size_x):
-                self.cursor_shape.append((y, x))
-        for y in range(2, self.char_size_y - 2):
-            for x in [0, 1, self.char_size_x - 2, self.char_size_x - 1]:
-                self.cursor_shape.append((y, x))
-        
+        """
+        Builds the cursor shape (a two pixel frame around the cell) as a pixel mask
+        """
+        self.cursor_mask = np.zeros((self.char_size_y, self.char_size_x), dtype=bool)
+        self.cursor_mask[[0, 1, self.char_size_y - 2, self.char_size_y - 1], :] = True
+        self.cursor_mask[:, [0, 1, self.char_size_x - 2, self.char_size_x - 1]] = True
     
     def get_char_size(self):
         """
@@ -87,16 +136,13 @@ class AnsiImage:
         
         old_height = self.height
         old_width = self.width
-        old_image = copy.deepcopy(self.ansi_image)
+        old_image = self.ansi_image
         
         self.clear_image(new_width, new_height)
-        if new_state == None:
-            for y in range(copy_height):
-                for x in range(copy_width):
-                    self.ansi_image[y][x] = old_image[y][x]
-            self.have_cache = False
+        if new_state is None:
+            self.ansi_image[:copy_height, :copy_width] = old_image[:copy_height, :copy_width]
         else:
-            self.ansi_image = copy.deepcopy(new_state)
+            self.ansi_image = new_state.copy()
             
         self.have_cache = False
         self.is_dirty = True
@@ -106,114 +152,209 @@ class AnsiImage:
         """
         True if a selection exists, False if no
         """
-        if self.selection == None or len(self.selection) == 0:
+        if self.selection is None or not self.selection.any():
             return False
         return True
     
+    def cell_mask(self, cells):
+        """
+        Returns a boolean cell mask from a list of (x, y) cells, dropping those outside 
+        the image, or a copy of the mask if given one
+        """
+        if isinstance(cells, np.ndarray) and cells.dtype == bool:
+            return cells.copy()
+        
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        cell_x, cell_y = np.array(list(cells), dtype=int).reshape(-1, 2).T
+        inside = (cell_x >= 0) & (cell_x < self.width) & (cell_y >= 0) & (cell_y < self.height)
+        mask[cell_y[inside], cell_x[inside]] = True
+        return mask
+    
+    def fit_mask(self, mask):
+        """
+        Crops or pads a cell mask to the current image size
+        """
+        if mask is None or mask.shape == (self.height, self.width):
+            return mask
+        fitted = np.zeros((self.height, self.width), dtype=bool)
+        copy_height, copy_width = min(self.height, mask.shape[0]), min(self.width, mask.shape[1])
+        fitted[:copy_height, :copy_width] = mask[:copy_height, :copy_width]
+        return fitted
+    
     def set_selection(self, new_selection_initial = None, append = False, remove = False, preliminary = False):
         """
-        Sets the selection list
+        Sets the selection, from a list of (x, y) cells or a boolean cell mask. None removes it.
+        
+        Selections replace, add to or (with remove) subtract from the current one. Preliminary 
+        selections are shown, but only made part of the selection by the next non-preliminary one.
+        
+        Only cells whose selected state changes get redrawn.
         """
-        self.redraw_set.update(self.selection_preliminary)
-        self.redraw_set.update(self.selection_preliminary_remove)
-        self.selection_preliminary = set()
-        self.selection_preliminary_remove = set()
-        if new_selection_initial != None:
-            new_selection = []
-            for entry in new_selection_initial:
-                if entry[0] < 0 or entry[0] >= self.width or entry[1] < 0 or entry[1] >= self.height:
-                    continue
-                new_selection.append(entry)
-                
-            new_selection = copy.deepcopy(new_selection)
-            if append == False or self.selection == None:
-                if self.selection != None:
-                    self.redraw_set.update(self.selection)
-                self.selection = set()
+        previous_mask = self.selection_mask()
+        self.selection_preliminary = None
+        self.selection_preliminary_remove = None
+        if new_selection_initial is not None:
+            new_selection = self.cell_mask(new_selection_initial)
+            if append == False or self.selection is None:
+                self.selection = np.zeros((self.height, self.width), dtype=bool)
             if preliminary == False:
-                for sel_element in new_selection:
-                    if remove == True and sel_element in self.selection:
-                        self.selection.remove(sel_element)
-                        self.redraw_set.add(sel_element)
-                    else:
-                        if remove == False:
-                            self.selection.add(sel_element)
-                            self.redraw_set.add(sel_element)
+                if remove == True:
+                    self.selection &= ~new_selection
+                else:
+                    self.selection |= new_selection
             else:
-                for sel_element in new_selection:
-                    if remove == True:
-                        self.selection_preliminary_remove.add(sel_element)
-                        self.redraw_set.add(sel_element)
-                    else:
-                        self.selection_preliminary.add(sel_element)
-                        self.redraw_set.add(sel_element)
+                if remove == True:
+                    self.selection_preliminary_remove = new_selection
+                else:
+                    self.selection_preliminary = new_selection
         else:
-            self.redraw_set.update(self.selection)
             self.selection = None
+        
+        # Redraw what changed
+        new_mask = self.selection_mask()
+        if previous_mask is None:
+            changed = new_mask
+        elif new_mask is None:
+            changed = previous_mask
+        else:
+            changed = previous_mask ^ new_mask
+        if changed is not None:
+            # Look for changed cells only within the rows and columns that have any
+            rows = np.flatnonzero(changed.any(axis = 1))
+            if len(rows) != 0:
+                start_y, end_y = rows[0], rows[-1] + 1
+                columns = np.flatnonzero(changed[start_y:end_y].any(axis = 0))
+                start_x, end_x = columns[0], columns[-1] + 1
+                changed_y, changed_x = np.nonzero(changed[start_y:end_y, start_x:end_x])
+                self.mark_redraw_cells(changed_x + start_x, changed_y + start_y)
+    
+    def set_selection_rect(self, start_x, start_y, end_x, end_y, append = False, remove = False, preliminary = False):
+        """
+        Sets the selection to a rectangle of cells (end exclusive), see set_selection
+        """
+        new_selection = np.zeros((self.height, self.width), dtype=bool)
+        new_selection[max(0, start_y):max(0, end_y), max(0, start_x):max(0, end_x)] = True
+        self.set_selection(new_selection, append = append, remove = remove, preliminary = preliminary)
             
+    def target_cells(self, cell_x = None, cell_y = None, rect = None, mask = None):
+        """
+        Returns cells given as arrays of x and y coordinates, a (start x, start y, end x, end y) 
+        rectangle (end exclusive) or a boolean cell mask as arrays of x and y coordinates, 
+        row by row for rectangles and masks.
+        
+        Also returns which of the given coordinates were inside the image, the others are dropped.
+        """
+        if rect is not None:
+            cell_y, cell_x = np.mgrid[rect[1]:rect[3], rect[0]:rect[2]]
+        elif mask is not None:
+            cell_y, cell_x = np.nonzero(self.fit_mask(mask))
+        
+        cell_x = np.asarray(cell_x, dtype=int).ravel()
+        cell_y = np.asarray(cell_y, dtype=int).ravel()
+        inside = (cell_x >= 0) & (cell_x < self.width) & (cell_y >= 0) & (cell_y < self.height)
+        return cell_x[inside], cell_y[inside], inside
+    
+    def set_cells(self, char = None, fore = None, back = None, cell_x = None, cell_y = None, rect = None, mask = None, ignore_allowed = False):
+        """
+        Sets the values of many cells at once, given like for target_cells. Values can be single 
+        values or arrays with one value per cell, in the same order. Only replaces values given, 
+        and cells outside the image are ignored. If a cell is given more than once, the last 
+        value wins.
+        
+        Returns an AnsiDelta that reverses the change
+        """
+        cell_x, cell_y, inside = self.target_cells(cell_x, cell_y, rect, mask)
+        
+        values = np.full((len(cell_x), 3), -1, dtype=np.int16)
+        for channel, value in enumerate((char, fore, back)):
+            if value is None or (ignore_allowed == False and self.write_allowed[channel] == False):
+                continue
+            value = np.asarray(value, dtype=np.int16).ravel()
+            if len(value) != 1:
+                value = value[inside]
+            values[:, channel] = value
+        
+        # Keep only the last value for each cell
+        if rect is None and mask is None and len(cell_x) != 0:
+            cell_keys = (cell_y * self.width + cell_x)[::-1]
+            _, last = np.unique(cell_keys, return_index = True)
+            if len(last) != len(cell_keys):
+                last = np.sort(len(cell_keys) - 1 - last)
+                cell_x, cell_y, values = cell_x[last], cell_y[last], values[last]
+        
+        write = AnsiDelta()
+        write.add_cells(cell_x, cell_y, values)
+        return write.apply(self)
+    
+    def get_cells(self, cell_x = None, cell_y = None, rect = None, mask = None):
+        """
+        Returns the values of many cells at once, given like for target_cells, as arrays of
+        x and y coordinates and an (n, 3) array of values for the cells inside the image
+        """
+        cell_x, cell_y, _ = self.target_cells(cell_x, cell_y, rect, mask)
+        return cell_x, cell_y, self.ansi_image[cell_y, cell_x]
+    
     def get_selected(self, skip_space = False, selection = None):
         """
         Returns the selected characters, offset-augmnented
         """
-        if selection == None:
+        if selection is None:
             selection = self.selection
-        if selection == None or len(selection) == 0:
-            selection = [(self.cursor_x, self.cursor_y)]
+        if selection is not None:
+            selection = self.cell_mask(selection)
+        if selection is None or not selection.any():
+            selection = self.cell_mask([(self.cursor_x, self.cursor_y)])
             
-        selected = []
-        min_x = 1000000000
-        min_y = 1000000000
-        for x, y in selection:
-            min_x = min(x, min_x)
-            min_y = min(y, min_y)
-            if not skip_space or self.ansi_image[y][x][0] != ord(' '):
-                selected.append([x, y, self.ansi_image[y][x]])
-        
-        for sel_item in selected:
-            sel_item[0] -= min_x
-            sel_item[1] -= min_y
+        sel_x, sel_y, sel_values = self.get_cells(mask = selection)
+        offset_x = sel_x - sel_x.min()
+        offset_y = sel_y - sel_y.min()
+        
+        if skip_space:
+            keep = sel_values[:, 0] != ord(' ')
+            offset_x, offset_y, sel_values = offset_x[keep], offset_y[keep], sel_values[keep]
             
-        return copy.deepcopy(selected)
+        return [list(item) for item in zip(offset_x.tolist(), offset_y.tolist(), sel_values.tolist())]
     
     def paste(self, paste_object, x = None, y = None):
         """
         Pastes at given or (default) cursor position
         
-        Returns what was there before
+        Returns an AnsiDelta that reverses the paste
         """
         if x == None:
             x = self.cursor_x
         
         if y == None:
             y = self.cursor_y
-            
-        inverse = []
-        for (x_off, y_off, char) in paste_object:
-            char_x = x + x_off
-            char_y = y + y_off
-            if char_x >= self.width or char_y >= self.height:
-                continue
-            char_inverse = self.set_cell(char = char[0], fore = char[1], back = char[2], x = char_x, y = char_y)
-            inverse.extend(char_inverse)
-        return inverse
+        
+        # One row of x offset, y offset, char, fore, back per cell
+        cells = np.fromiter(
+            itertools.chain.from_iterable((x_off, y_off, *char) for (x_off, y_off, char) in paste_object),
+            dtype=int,
+            count=len(paste_object) * 5
+        ).reshape(-1, 5)
+        return self.set_cells(
+            char = cells[:, 2], 
+            fore = cells[:, 3], 
+            back = cells[:, 4], 
+            cell_x = x + cells[:, 0], 
+            cell_y = y + cells[:, 1]
+        )
     
     def fill_selection(self, fill_char = None):
         """
         Fills the selection with a given character (default: space)
         
         If no selection, cursor is used.
+        
+        Returns an AnsiDelta that reverses the fill
         """
         if fill_char == None:
             fill_char = self.generate_ansi_char(' ', False, False, 0, 0)
             
-        selection = self.selection
-        if selection == None or len(selection) == 0:
-            selection = [(self.cursor_x, self.cursor_y)]
-        
-        inverse = []
-        for x, y in selection:
-            inverse.extend(self.set_cell(x = x, y = y, char = fill_char[0], fore = fill_char[1], back = fill_char[2]))
-        return inverse
+        if not self.has_selection():
+            return self.set_cells(char = fill_char[0], fore = fill_char[1], back = fill_char[2], cell_x = [self.cursor_x], cell_y = [self.cursor_y])
+        return self.set_cells(char = fill_char[0], fore = fill_char[1], back = fill_char[2], mask = self.selection)
         
     def shift_line(self, y = None, x = None, how_much = 1, fill_char = None):
         """
@@ -221,37 +362,12 @@ class AnsiImage:
         filling the holes with the given character (default: cursor, space).
         
         how_much can be negative to shift to the left.
-        """
-        if x == None:
-            x = self.cursor_x
         
+        Returns an AnsiDelta that reverses the shift
+        """
         if y == None:
             y = self.cursor_y
-        
-        if fill_char == None:
-            fill_char = self.generate_ansi_char(' ', False, False, 0, 0)
-        
-        inverse = []
-        for i in range(self.width):
-            inverse.append((i, y, copy.deepcopy(self.ansi_image[y][i])))
-            self.redraw_set.add((i, y))
-        
-        if how_much > 0:
-            new_line = self.ansi_image[y][:x]
-            for i in range(how_much):
-                new_line.append(copy.deepcopy(fill_char))
-            new_line += self.ansi_image[y][x:]
-            self.ansi_image[y] = new_line[:self.width]
-        
-        if how_much < 0:
-            new_line = self.ansi_image[y][:x]
-            new_line += self.ansi_image[y][x - how_much:]
-            for i in range(-how_much):
-                new_line.append(copy.deepcopy(fill_char))
-            self.ansi_image[y] = new_line[:self.width]
-        
-        self.is_dirty = True
-        return inverse
+        return self.shift_lines(y, y + 1, x, how_much, fill_char)
     
     def shift_column(self, y = None, x = None, how_much = 1, fill_char = None):
         """
@@ -259,44 +375,65 @@ class AnsiImage:
         """
         if x == None:
             x = self.cursor_x
-        
+        return self.shift_columns(x, x + 1, y, how_much, fill_char)
+    
+    def shift_lines(self, start_y = 0, end_y = None, x = None, how_much = 1, fill_char = None):
+        """
+        Shifts a range of lines (default: all) to the left or right, see shift_line
+        """
+        if x == None:
+            x = self.cursor_x
+        if end_y == None:
+            end_y = self.height
+        return self.shift_block(x, start_y, self.width, end_y, how_much, False, fill_char)
+    
+    def shift_columns(self, start_x = 0, end_x = None, y = None, how_much = 1, fill_char = None):
+        """
+        Shifts a range of columns (default: all) up or down, starting at the given y
+        """
         if y == None:
             y = self.cursor_y
+        if end_x == None:
+            end_x = self.width
+        return self.shift_block(start_x, y, end_x, self.height, how_much, True, fill_char)
+    
+    def shift_block(self, start_x, start_y, end_x, end_y, how_much, vertical, fill_char = None):
+        """
+        Shifts the cells in a rectangle (end exclusive) right, or down if vertical is set, 
+        by how_much in place, filling the holes with the given character (default: space)
         
-        # Swap and transpose
-        tmp = x
-        x = y
-        y = tmp
-        image_transposed = list(map(list, zip(*self.ansi_image)))
-        
-        # Now, the code is nearly the same as row shift
+        Returns an AnsiDelta that reverses the shift, holding only the cells that changed
+        """
         if fill_char == None:
             fill_char = self.generate_ansi_char(' ', False, False, 0, 0)
         
-        inverse = []
-        for i in range(self.height):
-            inverse.append((y, i, copy.deepcopy(self.ansi_image[i][y])))
-            self.redraw_set.add((y, i))
-        
-        if how_much > 0:
-            new_line = image_transposed[y][:x]
-            for i in range(how_much):
-                new_line.append(copy.deepcopy(fill_char))
-            new_line += image_transposed[y][x:]
-            image_transposed[y] = new_line[:self.height]
-        
-        if how_much < 0:
-            new_line = image_transposed[y][:x]
-            new_line += image_transposed[y][x - how_much:]
-            for i in range(-how_much):
-                new_line.append(copy.deepcopy(fill_char))
-            image_transposed[y] = new_line[:self.height]
+        block = self.ansi_image[start_y:end_y, start_x:end_x]
+        previous = block.copy()
+        if vertical == True:
+            self.shift_segment(block, how_much, fill_char)
+        else:
+            self.shift_segment(block.swapaxes(0, 1), how_much, fill_char)
         
+        inverse = AnsiDelta.difference(start_x, start_y, block, previous)
+        for _, x, y, values in inverse.parts:
+            self.mark_redraw(x, y, x + values.shape[1], y + values.shape[0])
         self.is_dirty = True
-        self.ansi_image = list(map(list, zip(*image_transposed)))
-        
         return inverse
     
+    def shift_segment(self, segment, how_much, fill_char):
+        """
+        Shifts the cells in a (view of a) line, column or block along its first axis 
+        by how_much in place, filling the holes with fill_char
+        """
+        segment_len = len(segment)
+        how_much = max(-segment_len, min(how_much, segment_len))
+        if how_much > 0:
+            segment[how_much:] = segment[:segment_len - how_much].copy()
+            segment[:how_much] = fill_char
+        if how_much < 0:
+            segment[:segment_len + how_much] = segment[-how_much:].copy()
+            segment[segment_len + how_much:] = fill_char
+    
     def generate_ansi_char(self, in_char, fg_bright, bg_bright, fg, bg, raw = False):
         """
         Generate ansi char as array: char idx, fg pal idx, bg pal idx
@@ -361,43 +498,26 @@ class AnsiImage:
         Sets the values of a character cell to the given values. Only replaces 
         values given. Uses cursor position if no position is given.
         
-        Returns the set cells previous value, position-augmented and as list for convenience
+        Returns an AnsiDelta that reverses the change
         """
         if x == None:
             x = self.cursor_x
         if y == None:
             y = self.cursor_y
         
-        prev_val = [x, y, [None, None, None]]
-        
-        if ignore_allowed == False and self.write_allowed[0] == False:
-            char = None
-            prev_val[2][0] = None
-            
-        if ignore_allowed == False and self.write_allowed[1] == False:
-            fore = None
-            prev_val[2][1] = None
-            
-        if ignore_allowed == False and self.write_allowed[2] == False:
-            back = None
-            prev_val[2][2] = None
-            
-        if char != None:
-            prev_val[2][0] = self.ansi_image[y][x][0]
-            self.ansi_image[y][x][0] = char
-        
-        if fore != None:
-            prev_val[2][1] = self.ansi_image[y][x][1]
-            self.ansi_image[y][x][1] = fore
-            
-        if back != None:
-            prev_val[2][2] = self.ansi_image[y][x][2]
-            self.ansi_image[y][x][2] = back
+        prev_val = [-1, -1, -1]
+        for channel, value in enumerate((char, fore, back)):
+            if value == None or (ignore_allowed == False and self.write_allowed[channel] == False):
+                continue
+            prev_val[channel] = int(self.ansi_image[y, x, channel])
+            self.ansi_image[y, x, channel] = value
         
         self.redraw_set.add((x, y))
-        
         self.is_dirty = True
-        return copy.deepcopy([prev_val])
+        
+        inverse = AnsiDelta()
+        inverse.add_rect(x, y, [[prev_val]])
+        return inverse
     
     def get_cell(self, x = None, y = None):
         """
@@ -407,7 +527,7 @@ class AnsiImage:
             x = self.cursor_x
         if y == None:
             y = self.cursor_y
-        return self.ansi_image[y][x]
+        return self.ansi_image[y, x].tolist()
     
     def get_cursor(self):
         """
@@ -421,10 +541,10 @@ class AnsiImage:
         """
         if y == None:
             y = self.cursor_y
-        for x in range(self.width - 1, -1, -1):
-            if self.ansi_image[y][x][0] != ord(' '):
-                return x
-        return -1
+        non_space = np.flatnonzero(self.ansi_image[y, :, 0] != ord(' '))
+        if len(non_space) == 0:
+            return -1
+        return int(non_space[-1])
     
     def dirty(self, keep = True):
         """
@@ -446,24 +566,26 @@ class AnsiImage:
         if new_height != None:
             self.height = new_height
     
-        self.ansi_image = []
-        for i in range(self.height):
-            line = []
-            for j in range(self.width):
-                line.append(self.generate_ansi_char(' ', False, False, 0, 0))
-            self.ansi_image.append(line)
+        self.ansi_image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.ansi_image[:] = self.generate_ansi_char(' ', False, False, 0, 0)
         self.have_cache = False
         
+        self.selection = self.fit_mask(self.selection)
+        self.selection_preliminary = self.fit_mask(self.selection_preliminary)
+        self.selection_preliminary_remove = self.fit_mask(self.selection_preliminary_remove)
+        
     def load_ans(self, ansi_path, wide_mode = False):
         """
-        Loads and parses and ansi file. Documentation of parse_ans applies.
+        Loads and parses and ansi file, a chunk at a time. Documentation of parse_ans applies.
         
-        wide_mode makes it so the parser doesn't insert line breaks at 80 characters.
+        wide_mode makes it so the parser doesn't insert line breaks at 80 characters, or
+        at the width given in the files SAUCE record if it has a larger one.
         """
+        sauce = AnsiSauce.read(ansi_path)
         with open(ansi_path, "rb") as f:
-            ansi_data = f.read()
-        self.parse_ans(ansi_data, wide_mode)
-        self.steps_since_autosave = 0
+            self.parse_ans_chunks(iter(lambda: f.read(AnsiImage.LOAD_CHUNK_SIZE), b""), wide_mode, sauce = sauce)
+        if self.autosave != None:
+            self.autosave.reset()
         self.is_dirty = False
         
     def parse_ans(self, ansi_bytes, wide_mode = False):
@@ -474,356 +596,721 @@ class AnsiImage:
         Within SGR, we care about 0 (reset), 1 (fg bright), 5 (bg bright), 30–37 (set fg), 40–47 (set bg).
 
         Everything else is ignored.
+        
+        If the content ends in a SAUCE record with a width over 80, lines wrap at that width instead
+        of at 80 characters. Narrower files end their lines with line breaks, and wrapping them at
+        their width as well would turn each of those into an extra empty line.
         """
-        ansi_lines = []
-        ansi_line = []
-        char_idx = 0
-        current_fg_bright = False
-        current_bg_bright = False
-        current_fg = 7
-        current_bg = 0
-        supported_controls = [ord('m'), ord('C'), ord('A'), ord('J'), ord('s'), ord('u'), ord('H')]
-        while char_idx < len(ansi_bytes) and ansi_bytes[char_idx] != 0x1A:
-            # Begin ansi escape
-            if ansi_bytes[char_idx] == 0x1B:
-                char_idx += 2 
-                escape_param_str = ""
-                escape_char = ""
-                while not ansi_bytes[char_idx] in supported_controls:
-                    escape_param_str += chr(ansi_bytes[char_idx])
-                    char_idx += 1
-                escape_char = chr(ansi_bytes[char_idx])
-                escape_params = []
-                if len(escape_param_str):
-                    escape_params = list(map(int, escape_param_str.split(";")))
-                
-                # SGR
-                if escape_char == 'm':
-                    for param in escape_params:
-                        if param == 0:
-                            current_fg_bright = False
-                            current_bg_bright = False
-                            current_fg = 7
-                            current_bg = 0
-                        
-                        if param == 1:
-                            current_fg_bright = True
-                        
-                        if param == 5:
-                            current_bg_bright = True
-                        
-                        if param >= 30 and param <= 37:
-                            current_fg = param - 30
-                            
-                        if param >= 40 and param <= 47:
-                            current_bg = param - 40
-                # CUF
-                if escape_char == 'C':
-                    if len(escape_params) == 0:
-                        continue
-                    for i in range(escape_params[0]):
-                        ansi_line.append(self.generate_ansi_char(
-                            ' ', 
-                            current_fg_bright, 
-                            current_bg_bright, 
-                            current_fg, 
-                            current_bg
-                        ))
-                        
-                char_idx += 1
-                continue
-                
-            # End of line
-            if ansi_bytes[char_idx] == 13:
-                char_idx += 1
-                continue
-            if ansi_bytes[char_idx] == 10:
-                ansi_lines.append(ansi_line)
-                ansi_line = []
-                char_idx += 1
-                continue
-            
-            # Normal character
-            ansi_line.append(self.generate_ansi_char(
-                ansi_bytes[char_idx], 
-                current_fg_bright, 
-                current_bg_bright, 
-                current_fg, 
-                current_bg,
-                raw = True
-            ))
-            
-            # If not wide mode and we're at 80 characters, break up the line
-            if not wide_mode and len(ansi_line) == 80:
-                ansi_lines.append(ansi_line)
-                ansi_line = []
-                char_idx += 1
-                continue
-            
-            char_idx += 1
-        if len(ansi_line) != 0:
-            ansi_lines.append(ansi_line)
-        
-        # Pad up to maximum length
-        line_len = max(map(len, ansi_lines))
-        if self.min_line_len != None:
-            line_len = max(line_len, self.min_line_len)
-        
-        for line in ansi_lines:
-            this_line_len = len(line)
-            for i in range(line_len - this_line_len):
-                line.append(self.generate_ansi_char(' ', False, False, 0, 0))
-                
-        self.ansi_image = ansi_lines
-        self.width = len(ansi_lines[0])
-        self.height = len(ansi_lines)
+        self.parse_ans_chunks([ansi_bytes], wide_mode, sauce = AnsiSauce.from_bytes(ansi_bytes))
+    
+    def parse_ans_chunks(self, ansi_chunks, wide_mode = False, max_bytes = None, max_rows = None, max_width = None, sauce = None):
+        """
+        Parses an .ans files content given as an iterable of chunks, parsing each chunk as soon
+        as it arrives. Documentation of parse_ans applies.
+        
+        The SAUCE record is only known up front if passed as sauce - otherwise, it is read from
+        the end of the content, and if it asks for other line lengths than 80 characters, the
+        content is parsed again with it.
+        
+        Input with more than max_bytes bytes, more than max_rows rows or rows longer than max_width
+        raises ValueError without reading further chunks. The image is only changed on success.
+        """
+        line_len = 80
+        if sauce != None and sauce.char_width() != None:
+            line_len = max(line_len, sauce.char_width())
+        
+        # Files from older versions of hanse have their real width in a mangled record. They are laid 
+        # out for that width, and parsed again if their content doesn't turn out to match it.
+        legacy_size = sauce.legacy_size() if sauce != None else None
+        if legacy_size != None:
+            read_chunks = []
+            parser = AnsiImage.parse_chunks(ansi_chunks, wide_mode, max(80, legacy_size[0]), max_bytes, max_rows, max_width, read_chunks)
+            if not sauce.fix_legacy_size(*parser.content_size()) and max(80, legacy_size[0]) != line_len:
+                parser = AnsiImage.parse_chunks(read_chunks, wide_mode, line_len, max_bytes, max_rows, max_width)
+        else:
+            # Without a record up front, the one at the end may still ask for other line lengths
+            read_chunks = [] if sauce == None else None
+            parser = AnsiImage.parse_chunks(ansi_chunks, wide_mode, line_len, max_bytes, max_rows, max_width, read_chunks)
+        ansi_image = parser.close(self.min_line_len)
+        
+        # A record that only arrived with the content: Parse again as if it had been passed up front
+        if sauce == None and parser.sauce != None:
+            if parser.sauce.legacy_size() != None or (parser.sauce.char_width() or 0) > line_len:
+                self.parse_ans_chunks(read_chunks, wide_mode, max_bytes, max_rows, max_width, parser.sauce)
+                return
+            sauce = parser.sauce
+        self.ansi_image = ansi_image
+        
+        self.sauce = sauce
+        self.height, self.width = self.ansi_image.shape[:2]
         self.have_cache = False
         
-    def str_to_bytes(self, string):
-        """
-        Basic string to list of bytes function. Valid only for printable < 128.
-        """
-        byte_list = []
-        for char in string:
-            byte_list.append(ord(char))
-        return byte_list
-    
-    def add_sauce(self, title = "", author = "", group = ""):
-        """
-        Generate a SAUCE tag.
-        
-        Sauce tags look like:
-        struct SAUCE
-        {
-            char           ID[5]; // "SAUCE"
-            char           Version[2]; // "00"
-            char           Title[35]; // title
-            char           Author[20]; // author
-            char           Group[20]; // group
-            char           Date[8]; // "CCYYMMDD", e.g. "20130504"
-            unsigned long  FileSize; // in bytes, nil legal
-            unsigned char  DataType; // 1 for character-based
-            unsigned char  FileType; // 1 for ANSI
-            unsigned short TInfo1; // Character width: 8
-            unsigned short TInfo2; // Nb. of lines
-            unsigned short TInfo3; // 0
-            unsigned short TInfo4; // 0
-            unsigned char  Comments; // 0
-            unsigned char  TFlags; // 00010011 - square pixel aspect, 8 pixel font, iCE colours
-            char           TInfoS[22]; // Font name - "IBM VGA"
-        };
-        
-        Full reference: http://www.acid.org/info/sauce/sauce.htm bless ACiD for documenting this so well y'all people own
-        """
-        sauce_bytes = [0x1a]
-        sauce_bytes += self.str_to_bytes("SAUCE00")
-        sauce_bytes += self.str_to_bytes(title.ljust(35))
-        sauce_bytes += self.str_to_bytes(author.ljust(20))
-        sauce_bytes += self.str_to_bytes(group.ljust(20))
-        sauce_bytes += self.str_to_bytes(time.strftime("%Y%m%d"))
-        sauce_bytes += [0, 0, 0, 0] # TODO make an effort to actually put file size here
-        sauce_bytes += [1]
-        sauce_bytes += [1]
-        sauce_bytes += [self.width % 256, self.height // 256]
-        sauce_bytes += [self.height % 256, self.width // 256]
-        sauce_bytes += [0, 0]
-        sauce_bytes += [0, 0]
-        sauce_bytes += [0]
-        sauce_bytes += [0b00010011]
-        sauce_bytes += self.str_to_bytes("IBM VGA".ljust(22, '\0'))
-        return sauce_bytes
+        self.selection = self.fit_mask(self.selection)
+        self.selection_preliminary = self.fit_mask(self.selection_preliminary)
+        self.selection_preliminary_remove = self.fit_mask(self.selection_preliminary_remove)
     
-    def to_ans(self):
+    @staticmethod
+    def parse_chunks(ansi_chunks, wide_mode, line_len, max_bytes, max_rows, max_width, read_chunks = None):
+        """
+        Feeds chunks of .ans content to a new AnsiParser and returns it, not closed yet.
+        Optionally also appends the chunks to the list read_chunks.
+        """
+        parser = AnsiParser(wide_mode, line_len, max_bytes = max_bytes, max_rows = max_rows, max_width = max_width)
+        for ansi_chunk in ansi_chunks:
+            if read_chunks != None:
+                read_chunks.append(ansi_chunk)
+            parser.feed(ansi_chunk)
+        return parser
+        
+    def add_sauce(self, title = None, author = None, group = None, file_size = 0):
         """
-        Returns a byte-array text representation of the image.
+        Generate a SAUCE tag (see AnsiSauce) for the image, as bytes to go at the end of the file.
         
-        No effort is made to reduce size at this time.
+        Title, author, group and comments are kept from the loaded files record unless given.
         """
-        ansi_bytes = []
-        for y in range(0, self.height):
-            for x in range(0, self.width):
-                char_info = self.ansi_image[y][x]
+        sauce = AnsiSauce(width = self.width, height = self.height, file_size = file_size)
+        if self.sauce != None:
+            sauce.title = self.sauce.title
+            sauce.author = self.sauce.author
+            sauce.group = self.sauce.group
+            sauce.comments = self.sauce.comments
+        
+        if title != None:
+            sauce.title = title
+        if author != None:
+            sauce.author = author
+        if group != None:
+            sauce.group = group
+        return sauce.to_bytes()
+    
+    @staticmethod
+    def sgr_change(fore, back, new_fore, new_back):
+        """
+        Returns an SGR escape that changes the colours from fore / back to new_fore / new_back,
+        setting only what changes.
+        """
+        change = (fore, back, new_fore, new_back)
+        if not change in AnsiImage.SGR_CHANGES:
+            # Brightness can only be turned off by resetting everything
+            sgr_params = []
+            if (fore >= 8 and new_fore < 8) or (back >= 8 and new_back < 8):
+                sgr_params.append("0")
+                fore = 7
+                back = 0
+            
+            if new_fore >= 8 and fore < 8:
+                sgr_params.append("1")
             
-                ansi_bytes += [0x1b] 
-                ansi_bytes += self.str_to_bytes('[0;')
+            if new_back >= 8 and back < 8:
+                sgr_params.append("5")
+            
+            if new_fore % 8 != fore % 8:
+                sgr_params.append(str((new_fore % 8) + 30))
+            
+            if new_back % 8 != back % 8:
+                sgr_params.append(str((new_back % 8) + 40))
+            AnsiImage.SGR_CHANGES[change] = b"\x1b[" + ";".join(sgr_params).encode("ascii") + b"m"
+        return AnsiImage.SGR_CHANGES[change]
+    
+    def write_ans(self, out_file, line_len = 80):
+        """
+        Writes the image in .ans format to a file-like object, a row at a time, followed by a SAUCE tag.
+        
+        Colours are only set when they change, runs of spaces become cursor forward moves and blank
+        cells at the end of rows are left out. Rows end with a line break unless they exactly fill 
+        a line_len wide line, which wraps by itself when loading. Images wider than that wrap at their
+        width instead, which the SAUCE tag tells readers about.
+        """
+        line_len = max(line_len, self.width)
+        
+        # Blank cells at the end of rows are left out, except that the first row keeps the width
+        is_blank = np.all(self.ansi_image == (ord(' '), 0, 0), axis = 2)
+        row_lens = self.width - np.argmin(is_blank[:, ::-1], axis = 1)
+        row_lens[np.all(is_blank, axis = 1)] = 0
+        if self.height != 0 and row_lens.max() < self.width:
+            row_lens[0] = self.width
+        
+        # Cursor forward moves must not reach the end of a wrapping line, or it won't wrap
+        def space_run(match, run_start):
+            run_len = len(match.group(0))
+            if run_start + match.end() >= line_len:
+                return b"\x1b[" + str(run_len - 1).encode("ascii") + b"C "
+            return b"\x1b[" + str(run_len).encode("ascii") + b"C"
+        
+        # Runs of cells with the same colours
+        colours = self.ansi_image[:, :, 1].astype(int) * 16 + self.ansi_image[:, :, 2]
+        colour_changes = colours[:, 1:] != colours[:, :-1]
+        
+        file_size = out_file.write(b"\x1b[0m")
+        fore = 7
+        back = 0
+        for y in range(self.height):
+            row_len = int(row_lens[y])
+            row_parts = []
+            if row_len != 0:
+                row_chars = self.ansi_image[y, :row_len, 0].tobytes()
+                row_fores = self.ansi_image[y, :row_len, 1].tolist()
+                row_backs = self.ansi_image[y, :row_len, 2].tolist()
+                run_bounds = [0] + (np.flatnonzero(colour_changes[y, :row_len - 1]) + 1).tolist() + [row_len]
+                for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+                    new_fore = row_fores[run_start]
+                    new_back = row_backs[run_start]
+                    if new_fore != fore or new_back != back:
+                        row_parts.append(AnsiImage.sgr_change(fore, back, new_fore, new_back))
+                        fore = new_fore
+                        back = new_back
                     
-                if char_info[1] >= 8:
-                    ansi_bytes += self.str_to_bytes('1;')
-                ansi_bytes += self.str_to_bytes(str((char_info[1] % 8) + 30) + ";")
-                
-                if char_info[2] >= 8:
-                    ansi_bytes += self.str_to_bytes("5;")
-                ansi_bytes += self.str_to_bytes(str((char_info[2] % 8) + 40))
-                
-                ansi_bytes += self.str_to_bytes("m")
-                ansi_bytes += [char_info[0]]
-            if self.width < 80: # If we're at 80 characters we omit the newline.
-                ansi_bytes += [10]
-        ansi_bytes += self.add_sauce()
-        return bytearray(ansi_bytes)
+                    run_chars = row_chars[run_start:run_end]
+                    if AnsiImage.SPACE_RUN.search(run_chars):
+                        run_chars = AnsiImage.SPACE_RUN.sub(lambda match: space_run(match, run_start), run_chars)
+                    row_parts.append(run_chars)
+            
+            if row_lens[y] != line_len:
+                row_parts.append(b"\n")
+            file_size += out_file.write(b"".join(row_parts))
+        out_file.write(self.add_sauce(file_size = file_size))
+    
+    def to_ans(self):
+        """
+        Returns a byte-array text representation of the image. See write_ans.
+        """
+        ansi_bytes = io.BytesIO()
+        self.write_ans(ansi_bytes)
+        return bytearray(ansi_bytes.getvalue())
     
     def save_ans(self, out_path):
         """
         Writes .ans file from this images contents
         """
         with open(out_path, "wb") as f:
-            f.write(self.to_ans())
+            self.write_ans(f)
     
-    def to_bitmap(self, transparent = False, cursor = False, area = None):
+    def html_rows(self):
         """
-        Returns pixel representation of this image as a PIL Image object
+        Generates the image as HTML, one string per row, each ending in a line break.
         
-        Can be passed an area. If so, only character cells overlapping the requested area will be
-        drawn. In this case the return value is a tuple of (real x start, real y start, bitmap image, actual size w, actual size h)
+        Runs of cells with the same colours become a single span with the classes fgN and bgN
+        for their palette indices. Characters are written as the unicode code points with the
+        same number, which is what the web font maps the glyphs to.
         """
-        if self.have_cache == False or self.cache_params != [transparent, cursor]:
-            self.ansi_bitmap = np.ones((self.char_size_y * self.height, self.char_size_x * self.width, 4))
-            for y in range(0, self.height):
-                for x in range(0, self.width):
-                    self.redraw_set.add((x, y))
-            self.have_cache = True
-        self.cache_params = [transparent, cursor]
+        colours = self.ansi_image[:, :, 1].astype(int) * 16 + self.ansi_image[:, :, 2]
+        colour_changes = colours[:, 1:] != colours[:, :-1]
+        for y in range(self.height):
+            row_chars = self.ansi_image[y, :, 0].tobytes().decode("latin-1")
+            row_colours = colours[y].tolist()
+            run_bounds = [0] + (np.flatnonzero(colour_changes[y]) + 1).tolist() + [self.width]
+            if self.width == 0:
+                run_bounds = []
+            row_parts = []
+            for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+                row_parts.append(AnsiImage.HTML_SPANS[row_colours[run_start]])
+                row_parts.append(row_chars[run_start:run_end].translate(AnsiImage.HTML_CHARS))
+                row_parts.append('</span>')
+            row_parts.append("\n")
+            yield "".join(row_parts)
+    
+    def render_cells(self, cells, cell_x, cell_y, transparent = False, cursor = False, selection = None):
+        """
+        Renders cell values with the given (broadcastable) cell coordinates to RGBA pixel blocks,
+        drawing cursor and selection inversion if requested.
         
-        for (x, y) in self.redraw_set:
-            if x >= self.width or y >= self.height:
-                continue
-            
-            char_info = self.ansi_image[y][x]
-            char_col = self.ansi_graphics.coloured_char(char_info[0], char_info[1], char_info[2])
-            self.ansi_bitmap[
-                self.char_size_y * y : self.char_size_y * (y + 1),
-                self.char_size_x * x : self.char_size_x * (x + 1),
-                0:3
-            ] = char_col
-            
-            # Make pixels transparent or no
-            if transparent == True and char_info[0] == ord(' '):
-                self.ansi_bitmap[
-                    self.char_size_y * y : self.char_size_y * (y + 1),
-                    self.char_size_x * x : self.char_size_x * (x + 1),
-                    3
-                ] = np.zeros((self.char_size_y, self.char_size_x))
-            else:
-                self.ansi_bitmap[
-                    self.char_size_y * y : self.char_size_y * (y + 1),
-                    self.char_size_x * x : self.char_size_x * (x + 1),
-                    3
-                ] = np.ones((self.char_size_y, self.char_size_x))
-                
-            # Draw cursor on top
-            if cursor == True and x == self.cursor_x and y == self.cursor_y:
-                for cursor_pix_y, cursor_pix_x in self.cursor_shape:
-                    self.ansi_bitmap[self.char_size_y * y + cursor_pix_y, self.char_size_x * x + cursor_pix_x, 0:3] = \
-                        1.0 - self.ansi_bitmap[self.char_size_y * y + cursor_pix_y, self.char_size_x * x + cursor_pix_x, 0:3]
-                    self.ansi_bitmap[self.char_size_y * y + cursor_pix_y, self.char_size_x * x + cursor_pix_x, 3] = 1.0
+        Returns an uint8 array of shape cells.shape[:-1] + (char height, char width, 4).
+        """
+        pixels = self.ansi_graphics.render_cells(cells)
+        
+        # Work on whole pixels: transparency and inversion are masks on the RGBA quadruplets
+        pixels_packed = pixels.view(np.uint32)[..., 0]
+        colour_bits = np.array([255, 255, 255, 0], dtype=np.uint8).view(np.uint32)[0]
+        alpha_bits = np.array([0, 0, 0, 255], dtype=np.uint8).view(np.uint32)[0]
+        
+        # Make pixels transparent or no
+        if transparent == True:
+            keep_bits = np.where(cells[..., 0] == ord(' '), colour_bits, colour_bits | alpha_bits)
+            pixels_packed &= keep_bits[..., np.newaxis, np.newaxis]
         
-        # Invert selection
         if cursor == True:
-            full_selection = self.selection_preliminary
-            if self.selection != None:
-                full_selection = full_selection.union(self.selection)
-            full_selection = full_selection.difference(self.selection_preliminary_remove)
-            
-            if len(full_selection) != 0:
-                for x, y in full_selection:
-                    if not (x, y) in self.redraw_set or x >= self.width or y >= self.height:
-                        continue
-                    self.ansi_bitmap[
-                        self.char_size_y * y : self.char_size_y * (y + 1),
-                        self.char_size_x * x : self.char_size_x * (x + 1),
-                        0:3
-                    ] = 1.0 - self.ansi_bitmap[
-                        self.char_size_y * y : self.char_size_y * (y + 1),
-                        self.char_size_x * x : self.char_size_x * (x + 1),
-                        0:3
-                    ]
-                    
-        redraw_start_x = self.width
-        redraw_start_y = self.height
-        redraw_end_x = 0
-        redraw_end_y = 0
-        for x, y in self.redraw_set:
-            redraw_start_x = min(x, redraw_start_x)
-            redraw_start_y = min(y, redraw_start_y)
-            redraw_end_x = max(x, redraw_end_x)
-            redraw_end_y = max(y, redraw_end_y)
+            # Draw cursor on top
+            at_cursor = np.nonzero((cell_x == self.cursor_x) & (cell_y == self.cursor_y))
+            cursor_block = pixels_packed[at_cursor]
+            cursor_block[..., self.cursor_mask] ^= colour_bits
+            cursor_block[..., self.cursor_mask] |= alpha_bits
+            pixels_packed[at_cursor] = cursor_block
             
+            # Invert selection
+            if selection is not None:
+                invert_bits = np.where(selection[cell_y, cell_x], colour_bits, 0).astype(np.uint32)
+                pixels_packed ^= invert_bits[..., np.newaxis, np.newaxis]
+        return pixels
+    
+    def selection_mask(self):
+        """
+        Returns the full (preliminary changes included) selection as a boolean cell mask, 
+        or None if nothing is selected
+        """
+        if self.selection is None:
+            mask = np.zeros((self.height, self.width), dtype=bool)
+        else:
+            mask = self.selection.copy()
+        if self.selection_preliminary is not None:
+            mask |= self.selection_preliminary
+        if self.selection_preliminary_remove is not None:
+            mask &= ~self.selection_preliminary_remove
+        
+        if not mask.any():
+            return None
+        return mask
+    
+    def mark_redraw(self, start_x, start_y, end_x, end_y):
+        """
+        Marks a rectangle of cells (end exclusive) as needing redrawing, for changes
+        too large to go through redraw_set cell by cell
+        """
+        start_x, end_x = max(0, start_x), min(end_x, self.width)
+        start_y, end_y = max(0, start_y), min(end_y, self.height)
+        if start_x < end_x and start_y < end_y:
+            self.redraw_areas.append((start_x, start_y, end_x, end_y))
+    
+    def mark_redraw_cells(self, cell_x, cell_y):
+        """
+        Marks the cells with the given x and y coordinates as needing redrawing. If there 
+        are a lot of them, they are marked as one rectangle per render cache tile instead.
+        """
+        if len(cell_x) == 0:
+            return
+        if len(cell_x) <= AnsiImage.REDRAW_CELLS_MAX:
+            self.redraw_set.update(zip(cell_x.tolist(), cell_y.tolist()))
+            return
+        
+        tiles_across = (self.width + AnsiImage.TILE_SIZE - 1) // AnsiImage.TILE_SIZE
+        tile_index = (cell_y // AnsiImage.TILE_SIZE) * tiles_across + cell_x // AnsiImage.TILE_SIZE
+        tiles, cell_tile = np.unique(tile_index, return_inverse = True)
+        start_x = np.full(len(tiles), self.width)
+        start_y = np.full(len(tiles), self.height)
+        end_x = np.zeros(len(tiles), dtype=int)
+        end_y = np.zeros(len(tiles), dtype=int)
+        np.minimum.at(start_x, cell_tile, cell_x)
+        np.minimum.at(start_y, cell_tile, cell_y)
+        np.maximum.at(end_x, cell_tile, cell_x + 1)
+        np.maximum.at(end_y, cell_tile, cell_y + 1)
+        for area in zip(start_x.tolist(), start_y.tolist(), end_x.tolist(), end_y.tolist()):
+            self.mark_redraw(*area)
+    
+    def pending_redraw(self, minimap = False):
+        """
+        Returns the cells that need redrawing as arrays of cell x and y coordinates from
+        redraw_set, and a list of cell rectangles, all clamped to the image. With minimap
+        set, leaves out the cells that the minimap has already redrawn.
+        """
+        redraw_set, redraw_areas = self.redraw_set, self.redraw_areas
+        if not minimap:
+            redraw_set = redraw_set | self.minimap_redrawn_set
+            redraw_areas = redraw_areas + self.minimap_redrawn_areas
+        
+        redraw = [(x, y) for x, y in redraw_set if x < self.width and y < self.height]
+        cell_x, cell_y = np.array(redraw, dtype=int).reshape(-1, 2).T
+        
+        areas = []
+        for start_x, start_y, end_x, end_y in redraw_areas:
+            end_x, end_y = min(end_x, self.width), min(end_y, self.height)
+            if start_x < end_x and start_y < end_y:
+                areas.append((start_x, start_y, end_x, end_y))
+        return cell_x, cell_y, areas
+    
+    @staticmethod
+    def union_bounds(bounds, other_bounds):
+        """
+        Returns the smallest cell rectangle containing two others, either of which may be None
+        """
+        if bounds == None:
+            return other_bounds
+        if other_bounds == None:
+            return bounds
+        return (
+            min(bounds[0], other_bounds[0]), 
+            min(bounds[1], other_bounds[1]), 
+            max(bounds[2], other_bounds[2]), 
+            max(bounds[3], other_bounds[3])
+        )
+    
+    def redraw_bounds(self):
+        """
+        Returns the cell rectangle (start x, start y, end x, end y) containing all cells that
+        need redrawing, or None if there are none
+        """
+        cell_x, cell_y, areas = self.pending_redraw()
+        bounds = None
+        if len(cell_x) != 0:
+            bounds = (int(cell_x.min()), int(cell_y.min()), int(cell_x.max()) + 1, int(cell_y.max()) + 1)
+        for area in areas:
+            bounds = AnsiImage.union_bounds(bounds, area)
+        return bounds
+    
+    def render_area(self, start_x, start_y, end_x, end_y, transparent = False, cursor = False, selection = None):
+        """
+        Renders a rectangle of cells to a new RGBA bitmap
+        """
+        cell_y, cell_x = np.mgrid[start_y:end_y, start_x:end_x]
+        pixels = self.render_cells(self.ansi_image[start_y:end_y, start_x:end_x], cell_x, cell_y, transparent, cursor, selection)
+        return pixels.transpose(0, 2, 1, 3, 4).reshape((end_y - start_y) * self.char_size_y, (end_x - start_x) * self.char_size_x, 4)
+    
+    def update_render_cache(self, transparent, cursor, selection):
+        """
+        Brings the cached tiles and the minimap up to date: Drops all tiles if the cache is invalid 
+        or was rendered with different settings, redraws the cells in redraw_set and redraw_areas otherwise
+        """
+        self.update_minimap(*self.pending_redraw(minimap = True))
+        cell_x, cell_y, areas = self.pending_redraw()
         self.redraw_set = set()
+        self.redraw_areas = []
+        self.minimap_redrawn_set = set()
+        self.minimap_redrawn_areas = []
         
-        if area != None:
-            start_x = min(area[0] // self.char_size_x, redraw_start_x)
-            end_x = max((area[2] // self.char_size_x) + 1, redraw_end_y)
-            
-            start_y = min(area[1] // self.char_size_y, redraw_start_y)
-            end_y = max((area[3] // self.char_size_y) + 1, redraw_end_y)
+        if self.have_cache == False or self.cache_params != [transparent, cursor]:
+            self.render_tiles.clear()
+            self.render_tiles_size = 0
+            self.have_cache = True
+            self.cache_params = [transparent, cursor]
+            return
+        
+        if len(self.render_tiles) == 0:
+            return
+        
+        # Areas: Redraw the part overlapping each cached tile
+        for start_x, start_y, end_x, end_y in areas:
+            for tile_key, tile in self.render_tiles.items():
+                tile_start_x = tile_key[0] * AnsiImage.TILE_SIZE
+                tile_start_y = tile_key[1] * AnsiImage.TILE_SIZE
+                draw_start_x, draw_end_x = max(start_x, tile_start_x), min(end_x, tile_start_x + AnsiImage.TILE_SIZE)
+                draw_start_y, draw_end_y = max(start_y, tile_start_y), min(end_y, tile_start_y + AnsiImage.TILE_SIZE)
+                if draw_start_x >= draw_end_x or draw_start_y >= draw_end_y:
+                    continue
+                tile[
+                    (draw_start_y - tile_start_y) * self.char_size_y : (draw_end_y - tile_start_y) * self.char_size_y,
+                    (draw_start_x - tile_start_x) * self.char_size_x : (draw_end_x - tile_start_x) * self.char_size_x
+                ] = self.render_area(draw_start_x, draw_start_y, draw_end_x, draw_end_y, transparent, cursor, selection)
+        
+        if len(cell_x) == 0:
+            return
+        
+        # Cells in tiles that aren't cached don't matter, those get rendered fresh when needed
+        tile_x = cell_x // AnsiImage.TILE_SIZE
+        tile_y = cell_y // AnsiImage.TILE_SIZE
+        tile_keys = [tile_key for tile_key in set(zip(tile_x.tolist(), tile_y.tolist())) if tile_key in self.render_tiles]
+        if len(tile_keys) == 0:
+            return
+        
+        tiles_across = (self.width + AnsiImage.TILE_SIZE - 1) // AnsiImage.TILE_SIZE
+        in_cached = np.isin(tile_y * tiles_across + tile_x, [key_y * tiles_across + key_x for key_x, key_y in tile_keys])
+        cell_x, cell_y, tile_x, tile_y = cell_x[in_cached], cell_y[in_cached], tile_x[in_cached], tile_y[in_cached]
+        pixels = self.render_cells(self.ansi_image[cell_y, cell_x], cell_x, cell_y, transparent, cursor, selection)
+        
+        for tile_key in tile_keys:
+            in_tile = (tile_x == tile_key[0]) & (tile_y == tile_key[1])
+            tile = self.render_tiles[tile_key]
             
-            return (
-                start_x * self.char_size_x, 
-                start_y * self.char_size_y, 
-                Image.fromarray((self.ansi_bitmap[
-                    start_y * self.char_size_y : end_y * self.char_size_y,
-                    start_x * self.char_size_x : end_x * self.char_size_x
-                ] * 255.0).astype('int8'), mode='RGBA'),
-                self.char_size_x * self.width,
-                self.char_size_y * self.height,
+            # The tile, viewed as a grid of cells: (cell y, pixel y, cell x, pixel x, channel)
+            tile_cells = tile.reshape(
+                tile.shape[0] // self.char_size_y, 
+                self.char_size_y, 
+                tile.shape[1] // self.char_size_x, 
+                self.char_size_x, 
+                4
             )
+            tile_cells[cell_y[in_tile] % AnsiImage.TILE_SIZE, :, cell_x[in_tile] % AnsiImage.TILE_SIZE] = pixels[in_tile]
+    
+    def render_tile(self, tile_x, tile_y, transparent, cursor, selection):
+        """
+        Returns the bitmap of a render cache tile, rendering it if it isn't cached
+        """
+        tile_key = (tile_x, tile_y)
+        if tile_key in self.render_tiles:
+            self.render_tiles.move_to_end(tile_key)
+            return self.render_tiles[tile_key]
+        
+        start_x = tile_x * AnsiImage.TILE_SIZE
+        start_y = tile_y * AnsiImage.TILE_SIZE
+        end_x = min(start_x + AnsiImage.TILE_SIZE, self.width)
+        end_y = min(start_y + AnsiImage.TILE_SIZE, self.height)
+        tile = self.render_area(start_x, start_y, end_x, end_y, transparent, cursor, selection)
+        self.render_tiles[tile_key] = tile
+        self.render_tiles_size += tile.nbytes
+        return tile
+    
+    def trim_render_cache(self):
+        """
+        Drops the least recently used tiles until the cache fits the memory budget
+        """
+        while self.render_tiles_size > self.render_cache_budget and len(self.render_tiles) != 0:
+            _, tile = self.render_tiles.popitem(last = False)
+            self.render_tiles_size -= tile.nbytes
+    
+    def area_cells(self, area):
+        """
+        Returns the cell rectangle (start x, start y, end x, end y) covering a pixel area, clamped to the image
+        """
+        start_x = max(0, min(area[0] // self.char_size_x, self.width))
+        end_x = max(start_x, min((area[2] // self.char_size_x) + 1, self.width))
+        start_y = max(0, min(area[1] // self.char_size_y, self.height))
+        end_y = max(start_y, min((area[3] // self.char_size_y) + 1, self.height))
+        return (start_x, start_y, end_x, end_y)
+    
+    def bitmap_tiles(self, transparent = False, cursor = False, area = None):
+        """
+        Returns the render cache tiles overlapping a pixel area (default: everything) as a list of 
+        (pixel x, pixel y, bitmap), with bitmaps being (height, width, 4) uint8 RGBA arrays.
+        
+        The bitmaps are the cache itself, not copies, and are updated in place by later calls.
+        
+        Tiles are TILE_SIZE x TILE_SIZE cells, and up to render_cache_budget bytes of them are 
+        kept, least recently used ones being dropped first.
+        """
+        selection = None
+        if cursor == True:
+            selection = self.selection_mask()
+        self.update_render_cache(transparent, cursor, selection)
+        
+        if area == None:
+            area = (0, 0, self.width * self.char_size_x - 1, self.height * self.char_size_y - 1)
+        start_x, start_y, end_x, end_y = self.area_cells(area)
+        
+        tiles = []
+        for tile_y in range(start_y // AnsiImage.TILE_SIZE, (end_y + AnsiImage.TILE_SIZE - 1) // AnsiImage.TILE_SIZE):
+            for tile_x in range(start_x // AnsiImage.TILE_SIZE, (end_x + AnsiImage.TILE_SIZE - 1) // AnsiImage.TILE_SIZE):
+                tiles.append((
+                    tile_x * AnsiImage.TILE_SIZE * self.char_size_x,
+                    tile_y * AnsiImage.TILE_SIZE * self.char_size_y,
+                    self.render_tile(tile_x, tile_y, transparent, cursor, selection)
+                ))
+        self.trim_render_cache()
+        return tiles
+    
+    def render_minimap_cells(self, cells):
+        """
+        Renders cells at minimap resolution
+        """
+        size_x, size_y, transparent = self.minimap_params
+        pixels = self.ansi_graphics.render_cells_coverage(cells, size_x, size_y)
+        if transparent == True:
+            pixels[..., 3] = np.where(cells[..., 0] == ord(' '), 0, 255)[..., np.newaxis, np.newaxis]
+        return pixels
+    
+    def has_minimap(self):
+        """
+        True if there is a minimap for the current cells and graphics
+        """
+        if self.minimap is None:
+            return False
+        return self.minimap_source[0] is self.ansi_image and self.minimap_source[1] is self.ansi_graphics
+    
+    def update_minimap(self, cell_x, cell_y, areas = []):
+        """
+        Redraws the given cells and cell rectangles of the minimap, if there is one
+        """
+        if not self.has_minimap():
+            return
+        size_x, size_y, _ = self.minimap_params
+        minimap_cells = self.minimap.reshape(self.height, size_y, self.width, size_x, 4)
+        
+        if len(cell_x) != 0:
+            minimap_cells[cell_y, :, cell_x] = self.render_minimap_cells(self.ansi_image[cell_y, cell_x])
+            self.minimap_changes = AnsiImage.union_bounds(
+                self.minimap_changes, 
+                (int(cell_x.min()), int(cell_y.min()), int(cell_x.max()) + 1, int(cell_y.max()) + 1)
+            )
+        
+        for start_x, start_y, end_x, end_y in areas:
+            chunk_rows = max(1, AnsiImage.MINIMAP_CHUNK_CELLS // (end_x - start_x))
+            for chunk_start_y in range(start_y, end_y, chunk_rows):
+                chunk_end_y = min(chunk_start_y + chunk_rows, end_y)
+                minimap_cells[chunk_start_y:chunk_end_y, :, start_x:end_x] = self.render_minimap_cells(
+                    self.ansi_image[chunk_start_y:chunk_end_y, start_x:end_x]
+                ).transpose(0, 2, 1, 3, 4)
+            self.minimap_changes = AnsiImage.union_bounds(self.minimap_changes, (start_x, start_y, end_x, end_y))
+    
+    def pop_minimap_changes(self):
+        """
+        Returns the cell rectangle (start x, start y, end x, end y) of the minimap that changed 
+        since the last call, or None if nothing did
+        """
+        changes = self.minimap_changes
+        self.minimap_changes = None
+        return changes
+    
+    def to_minimap(self, size_x, size_y, transparent = False):
+        """
+        Returns a low resolution overview of the image as a (height * size_y, width * size_x, 4) 
+        uint8 RGBA array, with size_x by size_y pixels per cell (at most the character size) that
+        mix fore and back colours by how much of them the characters glyph covers. Cursor and 
+        selection are not shown.
+        
+        The array is kept, and only the cells that change are redrawn in it from then on. 
+        pop_minimap_changes tells which ones did.
+        """
+        size_x = max(1, min(size_x, self.char_size_x))
+        size_y = max(1, min(size_y, self.char_size_y))
+        
+        if not self.has_minimap() or self.minimap_params != (size_x, size_y, transparent):
+            self.minimap_params = (size_x, size_y, transparent)
+            self.minimap_source = (self.ansi_image, self.ansi_graphics)
+            self.minimap = np.empty((self.height * size_y, self.width * size_x, 4), dtype=np.uint8)
+            minimap_cells = self.minimap.reshape(self.height, size_y, self.width, size_x, 4)
+            chunk_rows = max(1, AnsiImage.MINIMAP_CHUNK_CELLS // max(1, self.width))
+            for start_y in range(0, self.height, chunk_rows):
+                end_y = start_y + chunk_rows
+                minimap_cells[start_y:end_y] = self.render_minimap_cells(self.ansi_image[start_y:end_y]).transpose(0, 2, 1, 3, 4)
+            self.minimap_changes = (0, 0, self.width, self.height)
         else:
-            return Image.fromarray((self.ansi_bitmap * 255.0).astype('int8'), mode='RGBA')
+            # Cells that changed since the minimap was last brought up to date
+            self.update_minimap(*self.pending_redraw(minimap = True))
+        
+        # The render cache still has to redraw these, but the minimap is done with them
+        self.minimap_redrawn_set |= self.redraw_set
+        self.minimap_redrawn_areas += self.redraw_areas
+        self.redraw_set = set()
+        self.redraw_areas = []
+        return self.minimap
+    
+    def to_thumbnail(self, max_width, max_height, transparent = False):
+        """
+        Returns a reduced size version of the image as a PIL Image object, as large as fits 
+        into max_width by max_height pixels while keeping the aspect ratio, like PIL's thumbnail.
+        
+        Cells are drawn straight at about the reduced size, mixing fore and back colours by glyph 
+        coverage as in the minimap, and the result is box filtered down to the exact size, so the 
+        full resolution image is never made.
+        """
+        full_width, full_height = self.width * self.char_size_x, self.height * self.char_size_y
+        scale = min(max_width / max(1, full_width), max_height / max(1, full_height))
+        if scale >= 1.0:
+            return self.to_bitmap(transparent = transparent)
+        thumb_width = max(1, int(round(full_width * scale)))
+        thumb_height = max(1, int(round(full_height * scale)))
+        
+        # Pixels per cell, at least as many as the thumbnail has
+        size_x = max(1, int(np.ceil(self.char_size_x * scale)))
+        size_y = max(1, int(np.ceil(self.char_size_y * scale)))
+        pixels = np.empty((self.height * size_y, self.width * size_x, 4), dtype=np.uint8)
+        pixel_cells = pixels.reshape(self.height, size_y, self.width, size_x, 4)
+        chunk_rows = max(1, AnsiImage.MINIMAP_CHUNK_CELLS // max(1, self.width))
+        for start_y in range(0, self.height, chunk_rows):
+            cells = self.ansi_image[start_y:start_y + chunk_rows]
+            cell_pixels = self.ansi_graphics.render_cells_coverage(cells, size_x, size_y)
+            if transparent == True:
+                cell_pixels[..., 3] = np.where(cells[..., 0] == ord(' '), 0, 255)[..., np.newaxis, np.newaxis]
+            pixel_cells[start_y:start_y + chunk_rows] = cell_pixels.transpose(0, 2, 1, 3, 4)
+        
+        thumbnail = Image.fromarray(pixels, mode='RGBA')
+        return thumbnail.resize((thumb_width, thumb_height), Image.BOX)
+    
+    def to_bitmap_array(self, transparent = False, cursor = False):
+        """
+        Returns pixel representation of the whole image as a (height, width, 4) uint8 RGBA array, 
+        rendered directly without going through the render cache
+        """
+        selection = None
+        if cursor == True:
+            selection = self.selection_mask()
+        return self.render_area(0, 0, self.width, self.height, transparent, cursor, selection)
+    
+    def to_bitmap(self, transparent = False, cursor = False, area = None):
+        """
+        Returns pixel representation of this image as a PIL Image object
+        
+        Can be passed an area. If so, only character cells overlapping the requested area will be
+        drawn. In this case the return value is a tuple of (real x start, real y start, bitmap image, actual size w, actual size h)
+        
+        Areas are put together from the render cache (see bitmap_tiles), whole images are rendered directly.
+        """
+        if area == None:
+            return Image.fromarray(self.to_bitmap_array(transparent, cursor), mode='RGBA')
+        
+        start_x, start_y, end_x, end_y = self.area_cells(area)
+        start_x, end_x = start_x * self.char_size_x, end_x * self.char_size_x
+        start_y, end_y = start_y * self.char_size_y, end_y * self.char_size_y
+        
+        bitmap = np.empty((end_y - start_y, end_x - start_x, 4), dtype=np.uint8)
+        for tile_x, tile_y, tile in self.bitmap_tiles(transparent, cursor, area):
+            # Part of the tile that is in the area
+            copy_start_x, copy_end_x = max(start_x, tile_x), min(end_x, tile_x + tile.shape[1])
+            copy_start_y, copy_end_y = max(start_y, tile_y), min(end_y, tile_y + tile.shape[0])
+            bitmap[copy_start_y - start_y : copy_end_y - start_y, copy_start_x - start_x : copy_end_x - start_x] = \
+                tile[copy_start_y - tile_y : copy_end_y - tile_y, copy_start_x - tile_x : copy_end_x - tile_x]
+        
+        return (
+            start_x, 
+            start_y, 
+            Image.fromarray(bitmap, mode='RGBA'),
+            self.char_size_x * self.width,
+            self.char_size_y * self.height,
+        )
+    
+    def transform(self, transform, mask = None):
+        """
+        Applies an AnsiTransform to the whole image or, if given, the cells in a boolean cell mask
+        
+        Returns an AnsiDelta that reverses the change
+        """
+        transformed = transform.apply(self.ansi_image)
+        if mask is not None:
+            transformed = np.where(self.fit_mask(mask)[..., np.newaxis], transformed, self.ansi_image)
+        
+        inverse = AnsiDelta.difference(0, 0, transformed, self.ansi_image)
+        for _, x, y, values in inverse.parts:
+            end_x, end_y = x + values.shape[1], y + values.shape[0]
+            self.ansi_image[y:end_y, x:end_x] = transformed[y:end_y, x:end_x]
+            self.mark_redraw(x, y, end_x, end_y)
+            self.is_dirty = True
+        return inverse
     
     def deice(self):
         """
         Try to remove iCE colors from the image using closest visual matches
         and flipping fg/bg colors.
+        
+        Returns an AnsiDelta that reverses the change
         """
-        bg_color_conversion = [i if i < 8 else i % 8 for i in range(16)]
-
-        # A function to find the best matching non-iCE character
-        def find_best_char(in_char, fg, bg):
-            # An expanded lookup table for character replacements
-            char_conversion = {
-                32: 176,  # Space to light shade
-                176: 32,  # Light shade to space
-                177: 178, # Medium shade to dark shade
-                178: 177, # Dark shade to medium shade
-                219: 178, # Solid block to dark shade
-                220: 223, # Upper half block to lower half block
-                221: 222, # Right half block to left half block
-                222: 221, # Left half block to right half block
-                223: 220, # Lower half block to upper half block
-                254: 250, # Full block to small dot
-                249: 250, # Small dot to small dot
-            }
-
-            if bg > 7:
-                # Replace the character if necessary
-                if in_char in char_conversion:
-                    in_char = char_conversion[in_char]
-                    # Swap fg and bg colors when replacing the character
-                    fg, bg = bg, fg
+        return self.transform(AnsiTransform.deice())
 
-                # Replace the background color with the closest non-iCE color
-                bg = bg_color_conversion[bg]
-
-            return in_char, fg, bg
+    def snapshot(self):
+        """
+        Returns a copy of this image, with cells and SAUCE metadata but no rendering state
+        """
+        image = AnsiImage(self.ansi_graphics, self.min_line_len)
+        image.ansi_image = self.ansi_image.copy()
+        image.width = self.width
+        image.height = self.height
+        image.sauce = self.sauce
+        return image
+    
+    def read_only_view(self):
+        """
+        Returns an image that shares this one's cells, but can't change them, and has rendering
+        state of its own, so that several threads can render the same cells at once
+        """
+        image = AnsiImage(self.ansi_graphics, self.min_line_len)
+        image.ansi_image = self.ansi_image.view()
+        image.ansi_image.flags.writeable = False
+        image.width = self.width
+        image.height = self.height
+        image.sauce = self.sauce
+        return image
+    
+    def do_autosave(self):
+        """
+        Autosave occassionally, in the background (see AnsiAutosave). Call when adding/removing undo/redo steps
+        
+        Returns True if an autosave was started, False if no
+        """
+        if self.autosave == None:
+            return False
+        return self.autosave.step(self)
 
-        # Iterate through each pixel and replace iCE colors and characters
-        for x in range(self.width):
-            for y in range(self.height):
-                in_char, fg, bg = self.ansi_image[y][x]
-                self.ansi_image[y][x] = find_best_char(in_char, fg, bg)
-                self.redraw_set.add((x, y))
-        self.is_dirty = True
+    def close_autosave(self, timeout = None):
+        """
+        Write out any autosave still queued and stop the writer (see AnsiAutosave.close). Call before exiting
 
-    def do_autosave(self):
+        Returns True if everything was written, False if the timeout ran out
         """
-        Autosave occassionally. Call when adding/removing undo/redo steps
-        """
-        if not os.path.exists("autosaves"):
-            os.mkdir("autosaves")
-        self.steps_since_autosave += 1
-        if self.steps_since_autosave >= self.autosave_steps:
-            self.autosave_counter += 1
-            if self.autosave_counter > self.autosave_max:
-                self.autosave_counter = 0
-            self.save_ans(f"autosaves/autosave_{self.autosave_counter}.ans")
-            self.steps_since_autosave = 0
\ No newline at end of file
+        if self.autosave == None:
+            return True
+        return self.autosave.close(timeout)
@@ -0,0 +1,401 @@
+import numpy as np
+import re
+
+from AnsiSauce import AnsiSauce
+
+class AnsiParser:
+    """
+    Parses .ans file contents into a grid of character cells, either all at once or
+    incrementally as chunks of the file come in.
+
+    Rather than walking the input byte by byte, escape sequences and printable
+    characters are located with numpy, each distinct escape sequence is parsed once
+    and the position and colours of every character are computed as whole arrays.
+    """
+
+    # Characters that end an escape sequence
+    CONTROL_CHARS = b'mCAJsuH'
+    CONTROL_CHAR = re.compile(b'[' + CONTROL_CHARS + b']')
+
+    # Escapes up to this long (without the ESC and the byte after it) are told apart all at once,
+    # longer ones one by one, see parse_escapes
+    MAX_SHORT_ESCAPE = 16
+
+    # Parsed cells, packed into one value each, see parse_block
+    CELL_TYPE = np.dtype('<u4')
+
+    # Initial colour state: fg bright, bg bright, fg, bg
+    INITIAL_SGR = (0, 0, 7, 0)
+
+    # What escapes do, by escape sequence
+    ESCAPE_CACHE = {}
+
+    # Most data after the end of file marker that can be a SAUCE record with comments
+    MAX_TRAILER = AnsiSauce.RECORD_SIZE + 5 + 255 * AnsiSauce.COMMENT_LINE_SIZE
+
+    def __init__(self, wide_mode = False, line_len = 80, max_bytes = None, max_rows = None, max_width = None):
+        """
+        wide_mode makes it so the parser doesn't insert line breaks at line_len characters.
+
+        Optionally, input with more than max_bytes bytes (including everything after the end
+        of file marker), more than max_rows rows or rows longer than max_width is rejected
+        as soon as it is seen.
+        """
+        self.wide_mode = wide_mode
+        self.line_len = line_len
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.max_width = max_width
+        self.reset()
+
+    def reset(self):
+        """
+        Start over with an empty image
+        """
+        self.sgr_state = AnsiParser.INITIAL_SGR
+        self.line_count = 0 # Finished lines
+        self.max_line_len = 0
+        self.column = 0 # Length of the current line
+        self.stuck = False # A CUF went past the line end, so the current line can't wrap anymore
+        self.cells = []
+        self.byte_count = 0
+        self.pending = b'' # Incomplete escape at the end of the last chunk
+        self.at_eof = False
+        self.trailer = b'' # Data after the end of file marker, for SAUCE
+        self.sauce = None
+
+    def parse(self, ansi_bytes, min_line_len = None):
+        """
+        Parses an .ans files content. Assumes well-formed, breaks if not so.
+
+        Handled ansi escapes for us are SGR (m) and CUF (C).
+        Within SGR, we care about 0 (reset), 1 (fg bright), 5 (bg bright), 30–37 (set fg), 40–47 (set bg).
+
+        Everything else is ignored.
+
+        Returns the image as a (height, width, 3) uint8 array of char idx, fg pal idx and bg pal idx.
+        """
+        self.reset()
+        self.feed(ansi_bytes)
+        return self.close(min_line_len)
+
+    def feed(self, ansi_bytes):
+        """
+        Parses the next chunk of an .ans files content. Chunks can end anywhere, even in the
+        middle of an escape sequence.
+
+        Raises ValueError as soon as the input is malformed or over the limits.
+        """
+        self.byte_count += len(ansi_bytes)
+        if self.max_bytes != None and self.byte_count > self.max_bytes:
+            raise ValueError("Ansi data too large")
+
+        if self.at_eof:
+            self.trailer = (self.trailer + bytes(ansi_bytes))[-AnsiParser.MAX_TRAILER:]
+            return
+
+        ansi_bytes = self.pending + bytes(ansi_bytes)
+        self.pending = b''
+        eof_idx = ansi_bytes.find(0x1A)
+        if eof_idx != -1:
+            self.trailer = ansi_bytes[eof_idx + 1:][-AnsiParser.MAX_TRAILER:]
+            ansi_bytes = ansi_bytes[:eof_idx]
+            self.at_eof = True
+        else:
+            # Keep an escape that isn't complete yet for the next chunk
+            esc_idx = ansi_bytes.rfind(0x1B)
+            if esc_idx != -1 and AnsiParser.CONTROL_CHAR.search(ansi_bytes, esc_idx + 2) == None:
+                self.pending = ansi_bytes[esc_idx:]
+                ansi_bytes = ansi_bytes[:esc_idx]
+
+        if len(ansi_bytes) != 0:
+            self.parse_block(ansi_bytes)
+
+    def close(self, min_line_len = None):
+        """
+        Finishes parsing. Returns the image like parse does.
+
+        The SAUCE record after the end of the data, if any, ends up in sauce.
+        """
+        if len(self.pending) != 0:
+            raise ValueError("Unterminated escape sequence")
+        self.sauce = AnsiSauce.from_bytes(self.trailer)
+        return self.to_grid(min_line_len)
+
+    def check_limits(self):
+        """
+        Raises ValueError if what was parsed so far is over the row or width limits.
+        """
+        if self.max_rows != None and self.line_count + (self.column != 0) > self.max_rows:
+            raise ValueError("Ansi data has too many rows")
+
+        if self.max_width != None and max(self.max_line_len, self.column) > self.max_width:
+            raise ValueError("Ansi data has too long rows")
+
+    @staticmethod
+    def parse_escape(escape_str):
+        """
+        Parses one escape sequence (without the ESC and the byte after it).
+
+        Returns what it does to the colour state (fg bright, bg bright, fg, bg) as a tuple with
+        the new value of each, -1 where unchanged, and how far it moves the cursor forward.
+        """
+        if not escape_str in AnsiParser.ESCAPE_CACHE:
+            escape_char = escape_str[-1:]
+            escape_param_str = escape_str[:-1]
+            escape_params = []
+            if len(escape_param_str):
+                escape_params = list(map(int, escape_param_str.split(b";")))
+
+            # SGR
+            sgr_state = [-1, -1, -1, -1]
+            if escape_char == b'm':
+                for param in escape_params:
+                    if param == 0:
+                        sgr_state = list(AnsiParser.INITIAL_SGR)
+
+                    if param == 1:
+                        sgr_state[0] = 1
+
+                    if param == 5:
+                        sgr_state[1] = 1
+
+                    if param >= 30 and param <= 37:
+                        sgr_state[2] = param - 30
+
+                    if param >= 40 and param <= 47:
+                        sgr_state[3] = param - 40
+
+            # CUF
+            cuf_len = 0
+            if escape_char == b'C':
+                if len(escape_params) == 0:
+                    escape_params = [1]
+                cuf_len = max(escape_params[0], 0)
+
+            AnsiParser.ESCAPE_CACHE[escape_str] = (tuple(sgr_state), cuf_len)
+        return AnsiParser.ESCAPE_CACHE[escape_str]
+
+    @staticmethod
+    def control_mask(ansi_data):
+        """
+        Returns which bytes of ansi_data (as uint8 array) are control chars.
+        """
+        is_control = ansi_data == AnsiParser.CONTROL_CHARS[0]
+        for control_char in AnsiParser.CONTROL_CHARS[1:]:
+            is_control |= ansi_data == control_char
+        return is_control
+
+    def parse_escapes(self, ansi_bytes, ansi_data, esc_start, esc_end):
+        """
+        Parses escape sequences, each distinct one only once.
+
+        Returns the fg and bg pal idx before the first and after every escape, and the CUF
+        length of every escape (0 for anything that isn't a CUF).
+        """
+        esc_count = len(esc_start)
+
+        # Escape bytes after the ESC and the skipped byte (parameters and control char), zero padded
+        # to the same length so np.unique finds the distinct ones. They end in their control char,
+        # so the padding can't make two different escapes look the same.
+        escape_lens = esc_end - esc_start - 1
+        is_short = escape_lens <= AnsiParser.MAX_SHORT_ESCAPE
+        short_idx = np.flatnonzero(is_short)
+        short_width = max(int(escape_lens[short_idx].max(initial = 0)), 1)
+        padded_data = np.concatenate([ansi_data, np.zeros(short_width, dtype=np.uint8)])
+        short_bytes = np.empty((len(short_idx), short_width), dtype=np.uint8)
+        for i in range(short_width):
+            escape_column = padded_data[esc_start[short_idx] + 2 + i]
+            escape_column[escape_lens[short_idx] <= i] = 0
+            short_bytes[:, i] = escape_column
+        short_strs, short_inverse = np.unique(short_bytes.view("S" + str(short_width)).reshape(-1), return_inverse = True)
+        escape_strs = [bytes(escape_str) for escape_str in short_strs]
+        unique_inverse = np.empty(esc_count, dtype=np.intp)
+        unique_inverse[short_idx] = short_inverse.reshape(-1)
+
+        # Long escapes are rare, and padding everything to their length would take a lot of memory
+        long_strs = {}
+        for long_idx in np.flatnonzero(~is_short).tolist():
+            escape_str = ansi_bytes[esc_start[long_idx] + 2 : esc_end[long_idx] + 1]
+            if not escape_str in long_strs:
+                long_strs[escape_str] = len(escape_strs)
+                escape_strs.append(escape_str)
+            unique_inverse[long_idx] = long_strs[escape_str]
+
+        unique_sgr = np.empty((len(escape_strs), 4), dtype=int)
+        unique_cuf = np.empty(len(escape_strs), dtype=int)
+        for i, escape_str in enumerate(escape_strs):
+            unique_sgr[i], unique_cuf[i] = AnsiParser.parse_escape(escape_str)
+
+        # SGR escapes only ever set fields of the colour state, so repeating one changes nothing.
+        # Carry forward the last value set for each field (encoded as index * 16 + value, and
+        # below any of those for fields an escape leaves alone), one field at a time.
+        key_type = np.int32 if 16 * (esc_count + 2) < 2 ** 31 else np.int64
+        unique_offsets = np.where(unique_sgr >= 0, unique_sgr, -16 * (esc_count + 1)).T.astype(key_type)
+        index_keys = np.arange(16, 16 * (esc_count + 1), 16, dtype=key_type)
+        fields = np.empty((4, esc_count + 1), dtype=key_type)
+        fields[:, 0] = self.sgr_state
+        for field in range(4):
+            np.add(index_keys, unique_offsets[field][unique_inverse], out = fields[field, 1:])
+        np.maximum.accumulate(fields, axis = 1, out = fields)
+        fields &= 15
+        self.sgr_state = tuple(fields[:, -1].tolist())
+
+        fores = (fields[2] | fields[0] << 3).astype(np.uint8)
+        backs = (fields[3] | fields[1] << 3).astype(np.uint8)
+        return fores, backs, unique_cuf[unique_inverse]
+
+    def parse_block(self, ansi_bytes):
+        """
+        Parses a block of ansi data that contains only complete escape sequences, continuing
+        from the current state.
+        """
+        ansi_data = np.frombuffer(ansi_bytes, dtype=np.uint8)
+        data_len = len(ansi_data)
+
+        # Find escapes: ESC, one byte we skip, parameters, control char
+        esc_start = np.flatnonzero(ansi_data == 0x1B)
+        control_idx = np.flatnonzero(AnsiParser.control_mask(ansi_data))
+        esc_end_idx = np.searchsorted(control_idx, esc_start + 2)
+        if np.any(esc_end_idx == len(control_idx)):
+            raise ValueError("Unterminated escape sequence")
+        esc_end = control_idx[esc_end_idx]
+        if np.any(esc_start[1:] <= esc_end[:-1]):
+            raise ValueError("Escape sequence inside escape sequence")
+        fores, backs, cuf_lens = self.parse_escapes(ansi_bytes, ansi_data, esc_start, esc_end)
+
+        # Between escapes (and before the first) are runs of printable chars, line feeds and
+        # CRs, which are ignored. CUFs go at the start of the run after them, as their control char.
+        cuf_idx = np.flatnonzero(cuf_lens)
+        run_start = np.concatenate([[0], esc_end + 1])
+        run_start[cuf_idx + 1] -= 1
+        run_lens = np.concatenate([esc_start, [data_len]]) - run_start
+        run_offsets = np.cumsum(run_lens) - run_lens
+        event_idx = np.repeat(run_start - run_offsets, run_lens) + np.arange(run_offsets[-1] + run_lens[-1])
+        event_run = np.repeat(np.arange(len(run_lens)), run_lens)
+        event_chars = ansi_data[event_idx]
+        event_chars[run_offsets[cuf_idx + 1]] = ord(' ')
+        event_width = np.ones(len(event_idx), dtype=int)
+        event_width[run_offsets[cuf_idx + 1]] = cuf_lens[cuf_idx]
+        is_cuf = np.zeros(len(event_idx), dtype=bool)
+        is_cuf[run_offsets[cuf_idx + 1]] = True
+
+        not_cr = event_chars != 13
+        if not np.all(not_cr):
+            event_run = event_run[not_cr]
+            event_chars = event_chars[not_cr]
+            event_width = event_width[not_cr]
+            is_cuf = is_cuf[not_cr]
+        event_lf = event_chars == 10
+        event_width[event_lf] = 0
+        event_count = len(event_chars)
+
+        # Position of every event within its line feed separated segment
+        event_segment = np.cumsum(event_lf) - event_lf
+        event_start = np.cumsum(event_width) - event_width
+        lf_events = np.flatnonzero(event_lf)
+        segment_start = np.concatenate([[0], event_start[lf_events]])
+        segment_end = np.concatenate([event_start[lf_events], [event_width.sum()]])
+        segment_start[0] -= self.column
+        event_pos = event_start - segment_start[event_segment]
+        segment_len = segment_end - segment_start
+        segment_count = len(segment_start)
+
+        if self.wide_mode:
+            event_line = np.zeros(event_count, dtype=int)
+            segment_wraps = np.zeros(segment_count, dtype=int)
+            segment_stuck = np.zeros(segment_count, dtype=bool)
+        else:
+            # A character that fills up a line wraps it. A CUF that fills up or goes past the end
+            # doesn't, and the line stays unwrappable until the next line feed.
+            event_line = event_pos // self.line_len
+            stuck_event = np.full(segment_count, event_count)
+            stuck_line = np.zeros(segment_count, dtype=int)
+            if self.stuck:
+                stuck_event[0] = -1
+
+            cuf_events = np.flatnonzero(is_cuf)
+            stuck_cuf = cuf_events[event_pos[cuf_events] + event_width[cuf_events] >= (event_line[cuf_events] + 1) * self.line_len]
+            stuck_segment, first_stuck = np.unique(event_segment[stuck_cuf], return_index = True)
+            new_stuck = stuck_event[stuck_segment] != -1
+            stuck_event[stuck_segment[new_stuck]] = stuck_cuf[first_stuck[new_stuck]]
+            stuck_line[stuck_segment[new_stuck]] = event_line[stuck_cuf[first_stuck[new_stuck]]]
+
+            if self.stuck or len(stuck_cuf) != 0:
+                after_stuck = np.arange(event_count) >= stuck_event[event_segment]
+                event_line = np.where(after_stuck, stuck_line[event_segment], event_line)
+
+            segment_stuck = stuck_event < event_count
+            segment_wraps = np.where(segment_stuck, stuck_line, segment_len // self.line_len)
+        event_pos -= event_line * self.line_len
+
+        # Line feed separated segments make up one line each, plus one more for every wrap
+        segment_line = self.line_count + np.concatenate([[0], np.cumsum(segment_wraps + 1)[:-1]])
+        event_line += segment_line[event_segment]
+        segment_last_len = segment_len - segment_wraps * self.line_len
+        if np.any(segment_wraps != 0):
+            self.max_line_len = max(self.max_line_len, self.line_len)
+        self.max_line_len = max(self.max_line_len, int(segment_last_len[:-1].max(initial = 0)))
+        self.line_count = int(segment_line[-1] + segment_wraps[-1])
+        self.column = int(segment_last_len[-1])
+        self.stuck = bool(segment_stuck[-1])
+        self.check_limits()
+
+        # Expand everything into cells (packed as char, fg pal idx, bg pal idx, 0), CUFs being
+        # runs of spaces. Cells come in order, and never span lines, so each line gets one run of
+        # cells, which is kept as where it starts and where its cells are.
+        cell_events = np.flatnonzero(~event_lf)
+        if len(cell_events) == 0:
+            return
+        cell_count = event_width[cell_events]
+        run_colours = fores.astype(AnsiParser.CELL_TYPE) << 8 | backs.astype(AnsiParser.CELL_TYPE) << 16
+        cell_values = run_colours[event_run[cell_events]] | event_chars[cell_events]
+        cell_starts = np.arange(len(cell_events) + 1)
+        if len(cell_events) != cell_count.sum():
+            cell_values = np.repeat(cell_values, cell_count)
+            cell_starts = np.zeros(len(cell_events) + 1, dtype=np.intp)
+            np.cumsum(cell_count, out = cell_starts[1:])
+
+        cell_lines = event_line[cell_events]
+        first_line = int(cell_lines[0])
+        line_events = np.searchsorted(cell_lines, np.arange(first_line, int(cell_lines[-1]) + 2))
+        line_x = event_pos[cell_events][np.minimum(line_events[:-1], len(cell_events) - 1)]
+        self.cells.append((first_line, line_x, cell_starts[line_events], cell_values))
+
+    def content_size(self):
+        """
+        Returns the (width, height) in characters of everything parsed so far, before padding.
+        """
+        width = max(self.max_line_len, self.column)
+        height = self.line_count + (self.column != 0)
+        return width, height
+
+    def to_grid(self, min_line_len = None, completed_only = False):
+        """
+        Returns everything parsed so far as a (height, width, 3) uint8 array of char idx,
+        fg pal idx and bg pal idx, padding lines up to maximum length.
+
+        With completed_only, only returns the rows that are finished and won't change anymore.
+        """
+        height = self.line_count
+        width = self.max_line_len
+        if self.column != 0 and not completed_only:
+            height += 1
+            width = max(width, self.column)
+
+        if height == 0 and not completed_only:
+            raise ValueError("No ansi data")
+
+        if min_line_len != None:
+            width = max(width, min_line_len)
+
+        grid = np.full(height * width, ord(' '), dtype=AnsiParser.CELL_TYPE)
+        for first_line, line_x, line_cells, cell_values in self.cells:
+            if completed_only:
+                line_count = max(0, min(len(line_x), height - first_line))
+                line_x = line_x[:line_count]
+                line_cells = line_cells[:line_count + 1]
+                cell_values = cell_values[:line_cells[-1]]
+            line_offsets = (first_line + np.arange(len(line_x))) * width + line_x - line_cells[:-1]
+            grid[np.repeat(line_offsets, np.diff(line_cells)) + np.arange(len(cell_values))] = cell_values
+        return grid.view(np.uint8).reshape(height, width, 4)[:, :, :3].copy()
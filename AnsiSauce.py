@@ -0,0 +1,249 @@
+import struct
+import time
+
+class AnsiSauce:
+    """
+    SAUCE metadata, as stored at the end of ansi files.
+
+    Sauce records look like:
+    struct SAUCE
+    {
+        char           ID[5]; // "SAUCE"
+        char           Version[2]; // "00"
+        char           Title[35]; // title
+        char           Author[20]; // author
+        char           Group[20]; // group
+        char           Date[8]; // "CCYYMMDD", e.g. "20130504"
+        unsigned long  FileSize; // in bytes, nil legal
+        unsigned char  DataType; // 1 for character-based
+        unsigned char  FileType; // 1 for ANSI
+        unsigned short TInfo1; // Character width: 8
+        unsigned short TInfo2; // Nb. of lines
+        unsigned short TInfo3; // 0
+        unsigned short TInfo4; // 0
+        unsigned char  Comments; // Number of comment lines
+        unsigned char  TFlags; // 00010011 - square pixel aspect, 8 pixel font, iCE colours
+        char           TInfoS[22]; // Font name - "IBM VGA"
+    };
+
+    Comment lines are 64 characters each, and come in a block right before the record,
+    starting with "COMNT". The whole thing is preceded by an EOF character (0x1A).
+
+    Full reference: http://www.acid.org/info/sauce/sauce.htm bless ACiD for documenting this so well y'all people own
+    """
+    RECORD_SIZE = 128
+    COMMENT_LINE_SIZE = 64
+
+    # Everything after "SAUCE00"
+    RECORD_FIELDS = struct.Struct("<35s20s20s8sIBBHHHHBB22s")
+
+    # What older versions of hanse wrote into the flags and font name of every record
+    LEGACY_FLAGS = 0b00010011
+    LEGACY_FONT_NAME = "IBM VGA"
+
+    # Data types and file types for which TInfo1 and TInfo2 are width and height
+    DATA_TYPE_CHARACTER = 1
+    CHARACTER_FILE_TYPES = (0, 1, 2) # ASCII, ANSi, ANSiMation
+
+    def __init__(self, title = "", author = "", group = "", width = 80, height = 0, comments = [], date = None,
+                 file_size = 0, data_type = 1, file_type = 1, flags = 0b00010011, font_name = "IBM VGA"):
+        """
+        Creates a SAUCE record. The defaults describe an ANSi file for an 8 pixel wide IBM VGA font
+        with square pixels and iCE colours, dated today.
+        """
+        self.title = title
+        self.author = author
+        self.group = group
+        self.width = width
+        self.height = height
+        self.comments = list(comments)
+        self.date = date if date != None else time.strftime("%Y%m%d")
+        self.file_size = file_size
+        self.data_type = data_type
+        self.file_type = file_type
+        self.flags = flags
+        self.font_name = font_name
+
+    @staticmethod
+    def decode_field(field_bytes):
+        """
+        Returns a space or zero padded text field as string.
+        """
+        return field_bytes.decode("cp437").rstrip(" \0")
+
+    @staticmethod
+    def encode_field(field, field_len, pad = " "):
+        """
+        Returns a string as text field of the given length.
+        """
+        return field.encode("cp437", errors = "replace")[:field_len].ljust(field_len, pad.encode("ascii"))
+
+    @staticmethod
+    def from_record(record_bytes, comment_bytes = b""):
+        """
+        Creates a SAUCE record from its 128 bytes, and optionally the comment block before it.
+
+        Returns None if the bytes are not a SAUCE record.
+        """
+        if len(record_bytes) != AnsiSauce.RECORD_SIZE or record_bytes[:5] != b"SAUCE":
+            return None
+
+        title, author, group, date, file_size, data_type, file_type, width, height, _, _, _, flags, font_name = \
+            AnsiSauce.RECORD_FIELDS.unpack(record_bytes[7:])
+
+        comments = []
+        if comment_bytes[:5] == b"COMNT":
+            for comment_start in range(5, len(comment_bytes), AnsiSauce.COMMENT_LINE_SIZE):
+                comments.append(AnsiSauce.decode_field(comment_bytes[comment_start:comment_start + AnsiSauce.COMMENT_LINE_SIZE]))
+
+        return AnsiSauce(
+            title = AnsiSauce.decode_field(title),
+            author = AnsiSauce.decode_field(author),
+            group = AnsiSauce.decode_field(group),
+            width = width,
+            height = height,
+            comments = comments,
+            date = AnsiSauce.decode_field(date),
+            file_size = file_size,
+            data_type = data_type,
+            file_type = file_type,
+            flags = flags,
+            font_name = AnsiSauce.decode_field(font_name)
+        )
+
+    @staticmethod
+    def comment_block_size(record_bytes):
+        """
+        Returns how many bytes the comment block before a SAUCE record takes up.
+        """
+        comment_lines = record_bytes[104]
+        if comment_lines == 0:
+            return 0
+        return 5 + comment_lines * AnsiSauce.COMMENT_LINE_SIZE
+
+    @staticmethod
+    def from_bytes(ansi_bytes):
+        """
+        Reads the SAUCE record from the end of an ansi files contents.
+
+        Returns None if there isn't one.
+        """
+        record_bytes = bytes(ansi_bytes[-AnsiSauce.RECORD_SIZE:])
+        if len(record_bytes) != AnsiSauce.RECORD_SIZE or record_bytes[:5] != b"SAUCE":
+            return None
+
+        comment_size = AnsiSauce.comment_block_size(record_bytes)
+        comment_bytes = b""
+        if comment_size != 0 and comment_size + AnsiSauce.RECORD_SIZE <= len(ansi_bytes):
+            comment_bytes = bytes(ansi_bytes[-AnsiSauce.RECORD_SIZE - comment_size:-AnsiSauce.RECORD_SIZE])
+        return AnsiSauce.from_record(record_bytes, comment_bytes)
+
+    @staticmethod
+    def read(ansi_path):
+        """
+        Reads the SAUCE record of an ansi file, looking only at the end of the file.
+
+        Returns None if there isn't one.
+        """
+        with open(ansi_path, "rb") as f:
+            file_size = f.seek(0, 2)
+            if file_size < AnsiSauce.RECORD_SIZE:
+                return None
+
+            f.seek(-AnsiSauce.RECORD_SIZE, 2)
+            record_bytes = f.read(AnsiSauce.RECORD_SIZE)
+            if record_bytes[:5] != b"SAUCE":
+                return None
+
+            comment_size = AnsiSauce.comment_block_size(record_bytes)
+            comment_bytes = b""
+            if comment_size != 0 and comment_size + AnsiSauce.RECORD_SIZE <= file_size:
+                f.seek(-AnsiSauce.RECORD_SIZE - comment_size, 2)
+                comment_bytes = f.read(comment_size)
+        return AnsiSauce.from_record(record_bytes, comment_bytes)
+
+    def char_width(self):
+        """
+        Returns the width in characters, if this record describes a character based file and has one.
+        """
+        if self.data_type != AnsiSauce.DATA_TYPE_CHARACTER or not self.file_type in AnsiSauce.CHARACTER_FILE_TYPES:
+            return None
+
+        if self.width == 0:
+            return None
+        return self.width
+
+    def legacy_size(self):
+        """
+        Older versions of hanse wrote the high bytes of width and height swapped. If this record
+        looks like one of theirs (IBM VGA font, their flags, no file size or comments) and undoing
+        that changes anything, returns the width and height with it undone, otherwise None.
+
+        Whether the record really is one of theirs can only be told from the content, see
+        fix_legacy_size.
+        """
+        if self.file_size != 0 or len(self.comments) != 0 or self.flags != AnsiSauce.LEGACY_FLAGS or self.font_name != AnsiSauce.LEGACY_FONT_NAME:
+            return None
+        if self.data_type != AnsiSauce.DATA_TYPE_CHARACTER or self.file_type != 1:
+            return None
+
+        width = (self.width & 0xFF) | (self.height & 0xFF00)
+        height = (self.height & 0xFF) | (self.width & 0xFF00)
+        if width == self.width and height == self.height:
+            return None
+        return width, height
+
+    def fix_legacy_size(self, width, height):
+        """
+        Undoes the swapped high bytes older versions of hanse wrote, if the files content turned out
+        to be exactly as large as the record says with them undone.
+
+        Returns True if the size was fixed, False if not.
+        """
+        if self.legacy_size() != (width, height):
+            return False
+        self.width, self.height = width, height
+        return True
+
+    def to_bytes(self):
+        """
+        Returns the record, preceded by the EOF character and comments, as it goes at the end of a file.
+        Sizes that don't fit into the record are clamped to the largest it can hold.
+        """
+        comments = self.comments[:255]
+        sauce_bytes = b"\x1a"
+        if len(comments) != 0:
+            sauce_bytes += b"COMNT"
+            for comment in comments:
+                sauce_bytes += AnsiSauce.encode_field(comment, AnsiSauce.COMMENT_LINE_SIZE)
+
+        sauce_bytes += b"SAUCE00"
+        sauce_bytes += AnsiSauce.RECORD_FIELDS.pack(
+            AnsiSauce.encode_field(self.title, 35),
+            AnsiSauce.encode_field(self.author, 20),
+            AnsiSauce.encode_field(self.group, 20),
+            AnsiSauce.encode_field(self.date, 8),
+            self.file_size,
+            self.data_type,
+            self.file_type,
+            min(self.width, 0xFFFF),
+            min(self.height, 0xFFFF),
+            0,
+            0,
+            len(comments),
+            self.flags,
+            AnsiSauce.encode_field(self.font_name, 22, "\0")
+        )
+        return sauce_bytes
+
+    def describe(self):
+        """
+        Returns a short human readable description: Title, dimensions, author and group, if set.
+        """
+        description = self.title if self.title != "" else "untitled"
+        if self.char_width() != None:
+            description += " ({0}x{1})".format(self.width, self.height)
+        credits = " / ".join(credit for credit in (self.author, self.group) if credit != "")
+        if credits != "":
+            description += " by " + credits
+        return description
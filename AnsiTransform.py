@@ -0,0 +1,112 @@
+import numpy as np
+
+class AnsiTransform:
+    """
+    A transformation of ansi character cells, as a lookup table that maps every
+    (char, fore, back) combination to a new (char, fore, back) triplet.
+
+    Applying it to cells is one gather, no matter how complicated the rules it was
+    made from. Transforms can be chained with then.
+    """
+    # Character replacements used when removing iCE colours
+    DEICE_CHARS = {
+        32: 176,  # Space to light shade
+        176: 32,  # Light shade to space
+        177: 178, # Medium shade to dark shade
+        178: 177, # Dark shade to medium shade
+        219: 178, # Solid block to dark shade
+        220: 223, # Upper half block to lower half block
+        221: 222, # Right half block to left half block
+        222: 221, # Left half block to right half block
+        223: 220, # Lower half block to upper half block
+        254: 250, # Full block to small dot
+        249: 250, # Small dot to small dot
+    }
+
+    def __init__(self, table = None):
+        """
+        Creates a transform from a (256, 16, 16, 3) table, or one that changes nothing
+        """
+        if table is None:
+            table = np.stack(AnsiTransform.all_cells(), axis = -1)
+        self.table = np.ascontiguousarray(table, dtype=np.uint8)
+
+    @staticmethod
+    def all_cells():
+        """
+        Returns (256, 16, 16) arrays of the char, fore and back value of every table entry
+        """
+        return np.meshgrid(np.arange(256), np.arange(16), np.arange(16), indexing = "ij")
+
+    @staticmethod
+    def from_channels(char, fore, back):
+        """
+        Creates a transform from the new char, fore and back values of every table entry
+        """
+        return AnsiTransform(np.stack(np.broadcast_arrays(char, fore, back), axis = -1))
+
+    @staticmethod
+    def deice():
+        """
+        Removes iCE colours (bright backgrounds), using the closest non-bright background,
+        and replacing some characters by their inverse with colours flipped where that
+        looks closer
+        """
+        char, fore, back = AnsiTransform.all_cells()
+        char_conversion = np.arange(256)
+        has_conversion = np.zeros(256, dtype=bool)
+        for in_char, out_char in AnsiTransform.DEICE_CHARS.items():
+            char_conversion[in_char] = out_char
+            has_conversion[in_char] = True
+
+        ice = back > 7
+        flip = ice & has_conversion[char]
+        new_char = np.where(flip, char_conversion[char], char)
+        new_fore = np.where(flip, back, fore)
+        new_back = np.where(flip, fore, back)
+        new_back = np.where(ice, new_back % 8, new_back)
+        return AnsiTransform.from_channels(new_char, new_fore, new_back)
+
+    @staticmethod
+    def remap_colours(fore_map = None, back_map = None):
+        """
+        Replaces colours according to lists of 16 new palette indices for fore and back
+        """
+        char, fore, back = AnsiTransform.all_cells()
+        if fore_map is not None:
+            fore = np.asarray(fore_map)[fore]
+        if back_map is not None:
+            back = np.asarray(back_map)[back]
+        return AnsiTransform.from_channels(char, fore, back)
+
+    @staticmethod
+    def swap_colours():
+        """
+        Swaps fore and back colours
+        """
+        char, fore, back = AnsiTransform.all_cells()
+        return AnsiTransform.from_channels(char, back, fore)
+
+    @staticmethod
+    def replace_chars(char_map):
+        """
+        Replaces characters according to a dict of old to new character
+        """
+        char, fore, back = AnsiTransform.all_cells()
+        char_conversion = np.arange(256)
+        for in_char, out_char in char_map.items():
+            char_conversion[in_char] = out_char
+        return AnsiTransform.from_channels(char_conversion[char], fore, back)
+
+    def then(self, other):
+        """
+        Returns a transform that applies this one, then the other one
+        """
+        return AnsiTransform(other.apply(self.table))
+
+    def apply(self, cells):
+        """
+        Returns transformed cells for an (..., 3) array of cell values
+        """
+        index = (cells[..., 0].astype(np.int32) << 8) | (cells[..., 1].astype(np.int32) << 4) | cells[..., 2]
+        return np.take(self.table.reshape(-1, 3), index, axis = 0)
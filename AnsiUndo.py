@@ -0,0 +1,105 @@
+import collections
+
+class AnsiUndo:
+    """
+    Undo / redo history for an AnsiImage, kept as AnsiDeltas that reverse (or redo) each step.
+
+    Deltas only store the cells that changed, and when the whole history goes over its memory
+    budget, the oldest steps are dropped.
+    """
+    # Default memory budget, in bytes
+    HISTORY_BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, budget = None):
+        """
+        Optionally allows the specification of how many bytes the history may use
+        """
+        self.budget = budget if budget != None else AnsiUndo.HISTORY_BUDGET
+        self.clear()
+
+    def clear(self):
+        """
+        Forget all steps
+        """
+        self.undo_steps = collections.deque()
+        self.redo_steps = collections.deque()
+        self.size = 0
+        self.can_merge = False
+
+    def add(self, inverse, merge = False):
+        """
+        Adds a step, given as the delta that undoes it, and clears the redo steps.
+
+        If merge is set and nothing but adding steps happened since the last one, the two
+        are undone as a single step.
+        """
+        for step in self.redo_steps:
+            self.size -= step.nbytes()
+        self.redo_steps.clear()
+
+        if merge == True and self.can_merge == True and len(self.undo_steps) != 0 and self.undo_steps[-1].size == None:
+            previous = self.undo_steps.pop()
+            self.size -= previous.nbytes()
+            inverse = inverse.then(previous)
+
+        self.undo_steps.append(inverse)
+        self.size += inverse.nbytes()
+        self.can_merge = True
+        self.trim()
+
+    def seal(self):
+        """
+        Make sure the next step isn't merged into the last one
+        """
+        self.can_merge = False
+
+    def undo(self, image):
+        """
+        Undoes the last step on the image. Returns True if there was one, False if no
+        """
+        return self.replay(image, self.undo_steps, self.redo_steps)
+
+    def redo(self, image):
+        """
+        Redoes the last undone step on the image. Returns True if there was one, False if no
+        """
+        return self.replay(image, self.redo_steps, self.undo_steps)
+
+    def replay(self, image, from_steps, to_steps):
+        """
+        Applies the newest step of one stack, putting its inverse on the other
+        """
+        self.can_merge = False
+        if len(from_steps) == 0:
+            return False
+
+        step = from_steps.pop()
+        self.size -= step.nbytes()
+        inverse = step.apply(image)
+        to_steps.append(inverse)
+        self.size += inverse.nbytes()
+        self.trim()
+        return True
+
+    def trim(self):
+        """
+        Drops the oldest steps, undo steps first, until the history fits the memory budget
+        or only one step is left
+        """
+        while self.size > self.budget and len(self.undo_steps) + len(self.redo_steps) > 1:
+            if len(self.undo_steps) != 0:
+                self.size -= self.undo_steps.popleft().nbytes()
+            else:
+                self.size -= self.redo_steps.popleft().nbytes()
+
+    def has_undo(self):
+        """
+        True if there is something to undo
+        """
+        return len(self.undo_steps) != 0
+
+    def has_redo(self):
+        """
+        True if there is something to redo
+        """
+        return len(self.redo_steps) != 0
@@ -5,6 +5,8 @@ from PyQt5 import QtCore, QtGui, QtWidgets, Qt
 
 from AnsiGraphics import AnsiGraphics
 from AnsiImage import AnsiImage
+from AnsiDelta import AnsiDelta
+from AnsiUndo import AnsiUndo
 from AnsiPalette import AnsiPalette
 
 from ToolSelection import ToolSelection
@@ -32,6 +34,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.currentFileName = None
         self.previewBuffer = None
         
+        # Redraws happen at most once per frame
+        self.redrawInterval = 1000 // 60
+        self.redrawTimer = QtCore.QTimer(self)
+        self.redrawTimer.setSingleShot(True)
+        self.redrawTimer.timeout.connect(self.flushRedisplay)
+        self.redrawClock = QtCore.QElapsedTimer()
+        self.redrawClock.start()
+        self.lastViewState = None
+        
         # Load font
         self.fonts = json.load(open(os.path.join('config', 'fonts.json'), 'r'))
         
@@ -455,8 +466,11 @@ class MainWindow(QtWidgets.QMainWindow):
         
         transparent = self.toggleTransparent.isChecked()
         cursor = not self.toggleHideCursor.isChecked()
-        paint_x, paint_y, bitmap, size_x, size_y = self.ansiImage.to_bitmap(transparent = transparent, cursor = cursor, area = repaintCoords)
-        qtPixmap = QtGui.QPixmap.fromImage(ImageQt.ImageQt(bitmap))
+
+        # Paint straight from the render cache
+        tiles = self.ansiImage.bitmap_tiles(transparent = transparent, cursor = cursor, area = repaintCoords)
+        size_x = self.ansiImage.get_size()[0] * self.ansiImage.get_char_size()[0]
+        size_y = self.ansiImage.get_size()[1] * self.ansiImage.get_char_size()[1]
         
         painter = QtGui.QPainter(self.imageView)
         
@@ -469,8 +483,9 @@ class MainWindow(QtWidgets.QMainWindow):
             painter.setOpacity(refOpacity)
             painter.drawPixmap(0, 0, size_x, size_y, self.refImage)
             painter.setOpacity(1.0)
-            
-        painter.drawPixmap(paint_x, paint_y, qtPixmap)
+        
+        for tile_x, tile_y, tile in tiles:
+            painter.drawImage(tile_x, tile_y, self.bitmapToQImage(tile))
         
         if self.toggleReferenceImage.isChecked() == True and self.toggleReferenceImageTop.isChecked() == True:
             painter.setOpacity(refOpacity)
@@ -478,46 +493,108 @@ class MainWindow(QtWidgets.QMainWindow):
             
         painter.end()
         
+        self.imageView.setMinimumSize(size_x, size_y)
+        self.imageView.setMaximumSize(size_x, size_y)
+        self.updateCursorPositionLabel()
+        
+    def updatePreview(self, fullPreview = False):
+        """
+        Updates the preview, which shows the images minimap at a few pixels per cell. Only the
+        parts of the minimap that changed are copied, unless a full update is requested or needed.
+        """
+        transparent = self.toggleTransparent.isChecked()
         previewScale = 4
         if self.toggleSmallPreview.isChecked():
             previewScale = 8
             
-        preview_size_x = size_x // previewScale
-        preview_size_y = size_y // previewScale
+        previewCellX = max(1, self.ansiImage.get_char_size()[0] // previewScale)
+        previewCellY = max(1, self.ansiImage.get_char_size()[1] // previewScale)
+        minimap = self.ansiImage.to_minimap(previewCellX, previewCellY, transparent = transparent)
+        minimapImage = self.bitmapToQImage(minimap)
+        minimapChanges = self.ansiImage.pop_minimap_changes()
+        
+        preview_size_x = minimap.shape[1]
+        preview_size_y = minimap.shape[0]
         if self.previewBuffer == None or self.previewBuffer.width() != preview_size_x or self.previewBuffer.height() != preview_size_y:
             self.previewBuffer = QtGui.QPixmap(preview_size_x, preview_size_y)
-            previewBitmap = self.ansiImage.to_bitmap(transparent = transparent, cursor = cursor)
-            previewPixmap = QtGui.QPixmap.fromImage(ImageQt.ImageQt(previewBitmap))
-            preview_x = 0
-            preview_y = 0
-        else:
-            preview_x = paint_x // previewScale
-            preview_y = paint_y // previewScale
-            previewPixmap = qtPixmap
+            self.previewBuffer.fill(QtCore.Qt.transparent)
+            fullPreview = True
         
-        previewPixmap = previewPixmap.scaled(previewPixmap.width() // previewScale, previewPixmap.height() // previewScale, transformMode = QtCore.Qt.SmoothTransformation)
         previewPainter = QtGui.QPainter(self.previewBuffer)
-        previewPainter.drawPixmap(preview_x, preview_y, previewPixmap.width(), previewPixmap.height(), previewPixmap)
+        previewPainter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+        if fullPreview:
+            previewPainter.drawImage(0, 0, minimapImage)
+        elif minimapChanges != None:
+            previewRect = QtCore.QRect(
+                minimapChanges[0] * previewCellX, 
+                minimapChanges[1] * previewCellY, 
+                (minimapChanges[2] - minimapChanges[0]) * previewCellX, 
+                (minimapChanges[3] - minimapChanges[1]) * previewCellY
+            )
+            previewPainter.drawImage(previewRect, minimapImage, previewRect)
         previewPainter.end()
         
         self.imagePreview.setPixmap(self.previewBuffer)
         
-        self.imagePreview.setMinimumSize(size_x // previewScale, size_y // previewScale)
-        self.imagePreview.setMaximumSize(size_x // previewScale, size_y // previewScale)
-        
-        self.previewScroll.setMinimumSize(size_x // previewScale + 45, 1)
-        self.previewScroll.setMaximumSize(size_x // previewScale, 90001)
-        
-        self.imageView.setMinimumSize(size_x, size_y)
-        self.imageView.setMaximumSize(size_x, size_y)
-        self.updateCursorPositionLabel()
+        self.imagePreview.setMinimumSize(preview_size_x, preview_size_y)
+        self.imagePreview.setMaximumSize(preview_size_x, preview_size_y)
         
+        self.previewScroll.setMinimumSize(preview_size_x + 45, 1)
+        self.previewScroll.setMaximumSize(preview_size_x, 90001)
+    
+    def bitmapToQImage(self, bitmap):
+        """
+        Wraps a (height, width, 4) uint8 RGBA array as a QImage without copying it.
+        The array has to stay around for as long as the image is used.
+        """
+        return QtGui.QImage(bitmap.data, bitmap.shape[1], bitmap.shape[0], bitmap.strides[0], QtGui.QImage.Format_RGBA8888)
+    
     def redisplayAnsi(self):
         """
-        Redraws the ANSI label.
+        Schedules a redraw of the ANSI label. Redraws are limited to one per frame,
+        so that bursts of input end up as one redraw.
+        """
+        if not self.redrawTimer.isActive():
+            self.redrawTimer.start(max(0, self.redrawInterval - self.redrawClock.elapsed()))
+    
+    def flushRedisplay(self):
+        """
+        Redraws the parts of the ANSI label that changed since the last redraw, or all of it 
+        if the cached rendering or the view settings changed, and the preview.
         """
-        self.imageView.repaint()
-        self.imagePreview.repaint()
+        self.redrawClock.restart()
+        
+        transparent = self.toggleTransparent.isChecked()
+        cursor = not self.toggleHideCursor.isChecked()
+        viewState = (
+            transparent,
+            cursor,
+            self.toggleReferenceImage.isChecked(),
+            self.toggleReferenceImageTop.isChecked(),
+            tuple(toggle.isChecked() for toggle in self.toggleOpacity),
+            self.toggleSmallPreview.isChecked(),
+            self.refImage.cacheKey(),
+        )
+        
+        fullRedraw = self.ansiImage.have_cache == False or self.ansiImage.cache_params != [transparent, cursor]
+        fullRedraw = fullRedraw or self.previewBuffer == None or viewState != self.lastViewState
+        self.lastViewState = viewState
+        
+        redrawBounds = self.ansiImage.redraw_bounds()
+        if fullRedraw:
+            self.imageView.update()
+        else:
+            if redrawBounds != None:
+                charSizeX, charSizeY = self.ansiImage.get_char_size()
+                self.imageView.update(
+                    redrawBounds[0] * charSizeX, 
+                    redrawBounds[1] * charSizeY, 
+                    (redrawBounds[2] - redrawBounds[0]) * charSizeX, 
+                    (redrawBounds[3] - redrawBounds[1]) * charSizeY
+                )
+        
+        # The preview changes even where the view isn't visible, so it's updated here instead of when painting
+        self.updatePreview(fullRedraw)
         
     def redisplayPalette(self):
         """
@@ -629,18 +706,12 @@ class MainWindow(QtWidgets.QMainWindow):
         if event.key() == QtCore.Qt.Key_Insert:
             if (event.modifiers() & QtCore.Qt.ControlModifier == QtCore.Qt.ControlModifier):
                 if (event.modifiers() & QtCore.Qt.ShiftModifier == QtCore.Qt.ShiftModifier):
-                    inverse = []
-                    for col in range(self.ansiImage.get_size()[0]):
-                        inverse.extend(self.ansiImage.shift_column(x = col))
-                    self.addUndo(inverse)
+                    self.addUndo(self.ansiImage.shift_columns())
                 else:
                     self.addUndo(self.ansiImage.shift_column())
             else:
                 if (event.modifiers() & QtCore.Qt.ShiftModifier == QtCore.Qt.ShiftModifier):
-                    inverse = []
-                    for line in range(self.ansiImage.get_size()[1]):
-                        inverse.extend(self.ansiImage.shift_line(y = line))
-                    self.addUndo(inverse)
+                    self.addUndo(self.ansiImage.shift_lines())
                 else:
                     self.addUndo(self.ansiImage.shift_line())
             handled = True
@@ -651,18 +722,12 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 if (event.modifiers() & QtCore.Qt.ControlModifier == QtCore.Qt.ControlModifier):
                     if (event.modifiers() & QtCore.Qt.ShiftModifier == QtCore.Qt.ShiftModifier):
-                        inverse = []
-                        for col in range(self.ansiImage.get_size()[0]):
-                            inverse.extend(self.ansiImage.shift_column(x = col, how_much = -1))
-                        self.addUndo(inverse)
+                        self.addUndo(self.ansiImage.shift_columns(how_much = -1))
                     else:
                         self.addUndo(self.ansiImage.shift_column(how_much = -1))
                 else:
                     if (event.modifiers() & QtCore.Qt.ShiftModifier == QtCore.Qt.ShiftModifier):
-                        inverse = []
-                        for line in range(self.ansiImage.get_size()[1]):
-                            inverse.extend(self.ansiImage.shift_line(y = line, how_much = -1))
-                        self.addUndo(inverse)
+                        self.addUndo(self.ansiImage.shift_lines(how_much = -1))
                     else:
                         self.addUndo(self.ansiImage.shift_line(how_much = -1))
             handled = True
@@ -687,8 +752,9 @@ class MainWindow(QtWidgets.QMainWindow):
             char = self.palette.get_char()
             char[0] = ord(event.text())
             if char[0] <= 255:
-                self.addUndo(self.ansiImage.set_cell(char = char[0], fore = char[1], back = char[2]))
+                self.addUndo(self.ansiImage.set_cell(char = char[0], fore = char[1], back = char[2]), typing = True)
                 self.ansiImage.move_cursor(1, 0)
+                self.typingCursor = self.ansiImage.get_cursor()
             handled = True
             
         self.redisplayAnsi()
@@ -724,8 +790,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ansiImage = AnsiImage(self.ansiGraphics, has_autosave=True)
         self.ansiImage.clear_image(80, 24)
             
-        self.undoStack = []
-        self.redoStack = []
+        self.history = AnsiUndo()
+        self.typingCursor = None
         self.currentFileName = None
         self.previewBuffer = None
         
@@ -745,6 +811,7 @@ class MainWindow(QtWidgets.QMainWindow):
         if len(loadFileName) != 0:
             self.currentFileName = loadFileName
             self.ansiImage.load_ans(self.currentFileName, wideMode)
+            self.history.clear()
             self.previewBuffer = None
             
             self.redisplayAnsi()
@@ -786,14 +853,22 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         Remove iCE colors and replace them with closest non-iCE match assuming regular font
         """
-        self.ansiImage.deice()
+        self.addUndo(self.ansiImage.deice())
         self.redisplayAnsi()
         
     def exit(self):
         """
         Close everything and exit.
         """
+        self.ansiImage.close_autosave()
         sys.exit(0)
+
+    def closeEvent(self, event):
+        """
+        Window is closing: Make sure queued autosaves still get written
+        """
+        self.ansiImage.close_autosave()
+        event.accept()
         
     def clipboardCopy(self):
         """
@@ -891,50 +966,50 @@ class MainWindow(QtWidgets.QMainWindow):
         if sizeDialog.exec() == 1:
             new_width = sizeDialog.spinBoxWidth.value()
             new_height = sizeDialog.spinBoxHeight.value()
-            self.addUndo((-1, self.ansiImage.change_size(new_width, new_height)))
+            self.addUndo(AnsiDelta(size = (new_width, new_height)).apply(self.ansiImage))
             self.redisplayAnsi()
             
-    def addUndo(self, operation):
+    def addUndo(self, operation, typing = False):
+        """
+        Add an undo step (and clean out the redo stack), given as the AnsiDelta that
+        reverses it. Typing that goes on where the last typed character was put is 
+        undone in one go.
         """
-        Add an undo step (and clean out the redo stack)
+        merge = typing and self.typingCursor == self.ansiImage.get_cursor()
+        self.history.add(operation, merge)
+        self.typingCursor = None
+        self.autosave()
+        
+    def autosave(self):
+        """
+        Autosave in the background if it's time to, and show how long the last autosave took,
+        or why it failed
         """
-        self.undoStack.append(operation)
-        self.ansiImage.do_autosave()
-        self.redoStack = []
+        if self.ansiImage.do_autosave():
+            autosave = self.ansiImage.autosave
+            if autosave.last_error != None:
+                self.cursorPositionLabel.setToolTip("Autosave failed: {0}".format(autosave.last_error))
+            else:
+                self.cursorPositionLabel.setToolTip("Last autosave: {0:.1f} ms snapshot, {1:.1f} ms writing in the background".format(
+                    autosave.snapshot_time * 1000.0,
+                    autosave.write_time * 1000.0
+                ))
         
     def undo(self):
         """
         Undo last action
         """
-        try:
-            if len(self.undoStack) != 0:
-                undoAction = self.undoStack.pop()
-                if undoAction[0] == -1:
-                    undoAction = undoAction[1]
-                    self.redoStack.append((-1, self.ansiImage.change_size(undoAction[0], undoAction[1], undoAction[2])))
-                else:
-                    self.redoStack.append(self.ansiImage.paste(undoAction, x = 0, y = 0))
-                self.redisplayAnsi()
-                self.ansiImage.do_autosave()
-        except:
-            pass
+        if self.history.undo(self.ansiImage):
+            self.redisplayAnsi()
+            self.autosave()
             
     def redo(self):
         """
         Undo last undo
         """
-        try:
-            if len(self.redoStack) != 0:
-                redoAction = self.redoStack.pop()
-                if redoAction[0] == -1:
-                    redoAction = redoAction[1]
-                    self.undoStack.append((-1, self.ansiImage.change_size(redoAction[0], redoAction[1], redoAction[2])))
-                else:
-                    self.undoStack.append(self.ansiImage.paste(redoAction, x = 0, y = 0))
-                self.redisplayAnsi()
-                self.ansiImage.do_autosave()
-        except:
-            pass
+        if self.history.redo(self.ansiImage):
+            self.redisplayAnsi()
+            self.autosave()
 
     def changeTransparent(self):
         """
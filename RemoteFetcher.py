@@ -0,0 +1,140 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from WebCache import WebCache
+
+class RemoteFetcher:
+    """
+    Downloads remote files over a pooled session that keeps connections to each host
+    open between requests.
+
+    Downloads are limited in size and time, and only so many run at once. Files that came
+    with an ETag or Last-Modified header are kept, and asked for again conditionally, so
+    that unchanged files aren't downloaded a second time.
+    """
+    # How much to read at a time
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, max_bytes = 200 * 1024, timeout = 10.0, max_downloads = 4, pool_size = 8, cache_bytes = 32 * 1024 * 1024):
+        """
+        Files may be up to max_bytes large and take up to timeout seconds to download, at
+        most max_downloads run at the same time, up to pool_size connections per host are
+        kept open, and up to cache_bytes of downloaded files are kept for conditional requests
+        """
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.downloads = threading.BoundedSemaphore(max_downloads)
+
+        # (content, etag, last modified) of downloaded files, by url
+        self.cache = WebCache(cache_bytes)
+
+    @staticmethod
+    def time_left(deadline):
+        """
+        Returns how many seconds are left until deadline, raising ValueError if none are.
+        """
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            raise ValueError("download took too long")
+        return time_left
+
+    def open(self, url):
+        """
+        Starts downloading the file at url. Returns something that identifies this version of
+        the file - its ETag or Last-Modified header, None if it came with neither - and a generator
+        of its contents in chunks, which are read from the network as they are asked for.
+
+        Reading the chunks raises ValueError if the file is too large or takes too long, and requests'
+        exceptions if the download fails. Closing the generator stops the download, which ties up one
+        of the download slots until then.
+        """
+        deadline = time.monotonic() + self.timeout
+        cached = self.cache.get(url)
+        headers = {}
+        if cached != None:
+            _, etag, last_modified = cached
+            if etag != None:
+                headers["If-None-Match"] = etag
+            if last_modified != None:
+                headers["If-Modified-Since"] = last_modified
+
+        # Waiting for a free download slot and connecting count against the same deadline
+        if not self.downloads.acquire(timeout = RemoteFetcher.time_left(deadline)):
+            raise ValueError("too many downloads")
+        try:
+            response = self.session.get(url, headers = headers, stream = True, timeout = RemoteFetcher.time_left(deadline))
+        except:
+            self.downloads.release()
+            raise
+
+        try:
+            if response.status_code == 304:
+                # Only a conditional request can be answered with "not modified"
+                if cached == None:
+                    raise ValueError("not modified, but nothing was cached")
+                _, etag, last_modified = cached
+            else:
+                response.raise_for_status()
+                content_length = response.headers.get("Content-Length", "")
+                if content_length.isdigit() and int(content_length) > self.max_bytes:
+                    raise ValueError("response too large")
+                etag = response.headers.get("ETag", None)
+                last_modified = response.headers.get("Last-Modified", None)
+        except:
+            response.close()
+            self.downloads.release()
+            raise
+
+        # Started right away, so that closing it always lets go of the response and the slot
+        chunks = self.read_chunks(url, response, cached, etag, last_modified, deadline)
+        next(chunks)
+        return etag if etag != None else last_modified, chunks
+
+    def read_chunks(self, url, response, cached, etag, last_modified, deadline):
+        """
+        Generator for open: Yields once before reading anything, then the chunks of the response,
+        or the cached contents if it was a 304. Keeps what was read for conditional requests.
+        """
+        try:
+            yield b""
+            if response.status_code == 304:
+                # Reading the (empty) body lets the connection go back to the pool
+                response.content
+                yield cached[0]
+                return
+
+            # Reads time out by the deadline at the latest, so a stalled server counts as too slow.
+            # That includes the time whoever reads the chunks takes with each of them.
+            content = bytearray()
+            try:
+                for chunk in response.iter_content(RemoteFetcher.CHUNK_SIZE):
+                    content += chunk
+                    if len(content) > self.max_bytes:
+                        raise ValueError("response too large")
+                    RemoteFetcher.time_left(deadline)
+                    yield chunk
+            except requests.exceptions.ConnectionError:
+                RemoteFetcher.time_left(deadline)
+                raise
+        finally:
+            response.close()
+            self.downloads.release()
+
+        if etag != None or last_modified != None:
+            self.cache.set(url, (bytes(content), etag, last_modified), len(content))
+
+    def fetch(self, url):
+        """
+        Returns the contents of the file at url as bytes. Raises ValueError if it is too
+        large or takes too long, and requests' exceptions if the request fails.
+        """
+        _, chunks = self.open(url)
+        return b"".join(chunks)
@@ -67,7 +67,7 @@ class ToolSelection():
             
         self.selStartX = selStartX
         self.selStartY = selStartY
-        self.image.set_selection([(self.selStartX, self.selStartY)], append = append, remove = remove)
+        self.image.set_selection_rect(self.selStartX, self.selStartY, self.selStartX + 1, self.selStartY + 1, append = append, remove = remove)
         self.window.redisplayAnsi()
     
     def updateSelection(self, selEndX, selEndY, preliminary, append, remove):
@@ -86,18 +86,16 @@ class ToolSelection():
             selDirX = 1
             selDirY = 1   
             
-        if selEndX != self.selStartX or selEndY != self.selStartY:  
-            selection = []
-            for x in range(self.selStartX, selEndX + selDirX, selDirX):
-                for y in range(self.selStartY, selEndY + selDirY, selDirY):
-                    selection.append((x, y))
-            
-            
-            self.image.set_selection(selection, append = append, remove = remove, preliminary = preliminary)
-            self.window.redisplayAnsi()
-        else:
-            self.image.set_selection([(selEndX, selEndY)], append = append, remove = remove, preliminary = preliminary)
-            self.window.redisplayAnsi()
+        self.image.set_selection_rect(
+            min(self.selStartX, selEndX), 
+            min(self.selStartY, selEndY), 
+            max(self.selStartX, selEndX) + 1, 
+            max(self.selStartY, selEndY) + 1, 
+            append = append, 
+            remove = remove, 
+            preliminary = preliminary
+        )
+        self.window.redisplayAnsi()
             
         if preliminary:
             self.window.updateCursorPositionLabel("Selecting: ({0}, {1}) to ({2}, {3}) = {4} x {5}".format(
@@ -0,0 +1,89 @@
+import collections
+import threading
+
+class WebCache:
+    """
+    A least recently used cache of encoded responses or other values, bounded by the
+    total size of what it holds in bytes rather than by number of entries.
+
+    Safe to use from several request threads at once. Values made with get_or_load are
+    made only once even if several threads ask for them at the same time.
+    """
+    # Rough per-entry bookkeeping cost, for size accounting
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        """
+        Optionally allows the specification of how many bytes the cache may hold
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # Locks of keys that are being loaded right now
+        self.loading = {}
+        self.clear()
+
+    def clear(self):
+        """
+        Forget everything
+        """
+        # (value, size in bytes), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry == None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size = None):
+        """
+        Stores a value, dropping the least recently used entries until everything fits.
+        The size of the value in bytes defaults to its length. Values larger than the whole
+        cache are not stored.
+        """
+        if size == None:
+            size = len(value)
+        size += WebCache.ENTRY_OVERHEAD
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped_size) = self.entries.popitem(last = False)
+                self.size -= dropped_size
+
+    def get_or_load(self, key, load, size = None):
+        """
+        Returns the value stored for key, or calls load to make it and stores that. Other
+        threads asking for the same key meanwhile wait for it instead of loading it again.
+
+        size is a function that returns the size of a value in bytes, by default its length
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                value = self.get(key)
+                if value is None:
+                    value = load()
+                    self.set(key, value, None if size == None else size(value))
+            finally:
+                with self.lock:
+                    if self.loading.get(key) is key_lock:
+                        del self.loading[key]
+        return value
@@ -0,0 +1,450 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the parts of hanse that work without Qt (AnsiGraphics, AnsiImage, AnsiPalette,
+RemoteFetcher - against a local HTTP server).
+
+Reports throughput and peak memory of each benchmark and writes the results as json,
+by default to benchmark_results/<commit>.json, so runs on different commits can be
+compared with --compare.
+"""
+
+import argparse
+import functools
+import gc
+import glob
+import http.server
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+
+from AnsiGraphics import AnsiGraphics
+from AnsiImage import AnsiImage
+from AnsiUndo import AnsiUndo
+from AnsiTransform import AnsiTransform
+from AnsiAutosave import AnsiAutosave
+from AnsiPalette import AnsiPalette
+from RemoteFetcher import RemoteFetcher
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_DIR = os.path.join(BASE_DIR, "config")
+IMAGE_DIR = os.path.join(BASE_DIR, "images")
+
+# Synthetic canvases, as (width, height)
+LARGE_CANVASES = [(80, 10000), (400, 2000)]
+
+class Benchmark:
+    """
+    Something to time, and how much work it does in units of unit per run.
+
+    setup, if given, is called before every run, without being timed, and teardown once
+    after the last one.
+    """
+    def __init__(self, name, run, amount, unit, setup = None, teardown = None):
+        self.name = name
+        self.run = run
+        self.amount = amount
+        self.unit = unit
+        self.setup = setup
+        self.teardown = teardown
+
+    def measure(self, repeat):
+        """
+        Runs the benchmark repeat times, then once more with memory tracing, since
+        tracing slows everything down. Returns the results as a dict.
+        """
+        times = []
+        for _ in range(repeat):
+            if self.setup != None:
+                self.setup()
+            start_time = time.perf_counter()
+            self.run()
+            times.append(time.perf_counter() - start_time)
+
+        if self.setup != None:
+            self.setup()
+        gc.collect()
+        tracemalloc.start()
+        self.run()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if self.teardown != None:
+            self.teardown()
+
+        best_time = min(times)
+        return {
+            "name": self.name,
+            "unit": self.unit,
+            "amount": self.amount,
+            "runs": repeat,
+            "best_s": best_time,
+            "median_s": statistics.median(times),
+            "throughput": self.amount / best_time if best_time > 0 else None,
+            "peak_bytes": peak_bytes,
+        }
+
+def random_canvas(graphics, width, height, seed = 0):
+    """
+    Returns an image filled with runs of random characters and colours, with some blank
+    cells, so that it looks a bit like actual art to the parser and writer.
+    """
+    rng = np.random.default_rng(seed)
+    run_starts = rng.random(width * height) < 0.2
+    run_ids = np.cumsum(run_starts)
+    run_count = int(run_ids[-1]) + 1
+
+    run_cells = np.empty((run_count, 3), dtype=np.uint8)
+    run_cells[:, 0] = rng.choice([32, 176, 177, 178, 219, 220, 223, 65], run_count)
+    run_cells[:, 1] = rng.integers(0, 16, run_count)
+    run_cells[:, 2] = rng.integers(0, 16, run_count)
+    run_cells[rng.random(run_count) < 0.3] = (32, 0, 0)
+
+    image = AnsiImage(graphics)
+    image.clear_image(width, height)
+    image.ansi_image[:] = run_cells[run_ids].reshape(height, width, 3)
+    return image
+
+def ansi_files():
+    """
+    Returns the paths of all the .ans files in images/
+    """
+    return sorted(glob.glob(os.path.join(IMAGE_DIR, "*.ans")))
+
+def font_benchmarks(cache_dir):
+    """
+    Decoding and (cached) loading of every font in fonts.json, caching in cache_dir
+    """
+    with open(os.path.join(CONFIG_DIR, "fonts.json"), "r") as f:
+        fonts = json.load(f)
+
+    benchmarks = []
+    for font in fonts:
+        font_file = os.path.join(CONFIG_DIR, font["file"])
+        font_args = (font_file, font["width"], font["height"])
+
+        # Fill the cache once, so that loads measure the cached path the editor normally takes
+        AnsiGraphics.load_font(*font_args, cache_dir = cache_dir)
+        benchmarks.append(Benchmark("font_decode/" + font["file"], lambda font_args = font_args: AnsiGraphics.decode_font(*font_args), 256, "glyphs"))
+        benchmarks.append(Benchmark("font_load/" + font["file"], lambda font_args = font_args: AnsiGraphics(*font_args, cache_dir = cache_dir), 256, "glyphs"))
+    return benchmarks
+
+def ans_benchmarks(graphics):
+    """
+    parse_ans, to_ans and html_rows on every file in images/ and on large synthetic canvases
+    """
+    sources = []
+    for ansi_path in ansi_files():
+        with open(ansi_path, "rb") as f:
+            sources.append((os.path.basename(ansi_path), f.read()))
+
+    for width, height in LARGE_CANVASES:
+        canvas = random_canvas(graphics, width, height)
+        sources.append(("canvas_{0}x{1}".format(width, height), bytes(canvas.to_ans())))
+
+    benchmarks = []
+    for name, ansi_bytes in sources:
+        image = AnsiImage(graphics)
+        image.parse_ans(ansi_bytes)
+        benchmarks.append(Benchmark("parse_ans/" + name, lambda image = image, ansi_bytes = ansi_bytes: image.parse_ans(ansi_bytes), len(ansi_bytes), "bytes"))
+        benchmarks.append(Benchmark("to_ans/" + name, image.to_ans, image.width * image.height, "cells"))
+        benchmarks.append(Benchmark("html_rows/" + name, lambda image = image: "".join(image.html_rows()), image.width * image.height, "cells"))
+    return benchmarks
+
+def bitmap_benchmarks(graphics):
+    """
+    Full and partial to_bitmap and gallery thumbnails, on every file in images/ and a synthetic canvas,
+    and the minimap
+    """
+    images = []
+    for ansi_path in ansi_files():
+        image = AnsiImage(graphics)
+        image.load_ans(ansi_path)
+        images.append((os.path.basename(ansi_path), image))
+    images.append(("canvas_80x1000", random_canvas(graphics, 80, 1000)))
+
+    benchmarks = []
+    for name, image in images:
+        def invalidate(image = image):
+            image.have_cache = False
+        benchmarks.append(Benchmark("to_bitmap_full/" + name, image.to_bitmap, image.width * image.height, "cells", setup = invalidate))
+        benchmarks.append(Benchmark("to_thumbnail/" + name, lambda image = image: image.to_thumbnail(256, 256), image.width * image.height, "cells"))
+
+    # Redrawing a small area after editing a few cells in it, like the editor does on every key press
+    image = images[-1][1]
+    rng = np.random.default_rng(1)
+    cells = list(zip(rng.integers(0, 16, 64).tolist(), rng.integers(0, 8, 64).tolist()))
+    char_size_x, char_size_y = image.get_char_size()
+    area = (0, 0, 16 * char_size_x, 8 * char_size_y)
+    def mark_cells():
+        image.to_bitmap(area = area)
+        image.redraw_set.update(cells)
+    benchmarks.append(Benchmark("to_bitmap_partial/canvas_80x1000", lambda: image.to_bitmap(area = area), len(cells), "cells", setup = mark_cells))
+    
+    # The minimap, built from scratch and then kept up to date
+    def drop_minimap():
+        image.minimap = None
+    def mark_minimap_cells():
+        image.to_minimap(2, 4)
+        image.redraw_set.update(cells)
+    benchmarks.append(Benchmark("to_minimap_full/canvas_80x1000", lambda: image.to_minimap(2, 4), image.width * image.height, "cells", setup = drop_minimap))
+    benchmarks.append(Benchmark("to_minimap_partial/canvas_80x1000", lambda: image.to_minimap(2, 4), len(cells), "cells", setup = mark_minimap_cells))
+    return benchmarks
+
+def edit_benchmarks(graphics, temp_dir):
+    """
+    Editing operations: set_cell bursts, line and column shifts, large selections, paste, fill, undo / redo,
+    autosaves (into temp_dir), deice and other transforms
+    """
+    benchmarks = []
+    rng = np.random.default_rng(2)
+
+    burst_image = random_canvas(graphics, 80, 10000)
+    burst = list(zip(
+        rng.integers(0, 256, 10000).tolist(),
+        rng.integers(0, 16, 10000).tolist(),
+        rng.integers(0, 16, 10000).tolist(),
+        rng.integers(0, 80, 10000).tolist(),
+        rng.integers(0, 10000, 10000).tolist(),
+    ))
+    def set_cells():
+        for char, fore, back, x, y in burst:
+            burst_image.set_cell(char = char, fore = fore, back = back, x = x, y = y)
+    benchmarks.append(Benchmark("set_cell/canvas_80x10000", set_cells, len(burst), "cells"))
+
+    for width, height in LARGE_CANVASES:
+        name = "canvas_{0}x{1}".format(width, height)
+        image = random_canvas(graphics, width, height)
+        positions = list(zip(rng.integers(0, width, 200).tolist(), rng.integers(0, height, 200).tolist()))
+        def shift_lines(image = image, positions = positions):
+            for i, (x, y) in enumerate(positions):
+                image.shift_line(y = y, x = x, how_much = 1 if i % 2 == 0 else -1)
+        def shift_columns(image = image, positions = positions):
+            for i, (x, y) in enumerate(positions):
+                image.shift_column(y = y, x = x, how_much = 1 if i % 2 == 0 else -1)
+        benchmarks.append(Benchmark("shift_line/" + name, shift_lines, len(positions), "shifts"))
+        benchmarks.append(Benchmark("shift_column/" + name, shift_columns, len(positions), "shifts"))
+
+        # Inserting and deleting a whole column and row, as ctrl+shift+ins/del do
+        def insert_delete(image = image, positions = positions):
+            for x, y in positions[:10]:
+                image.shift_lines(x = x)
+                image.shift_lines(x = x, how_much = -1)
+                image.shift_columns(y = y)
+                image.shift_columns(y = y, how_much = -1)
+        benchmarks.append(Benchmark("insert_delete_all/" + name, insert_delete, 40, "shifts"))
+
+        # Selecting a large rectangle, then adding a second one to it
+        rect_width, rect_height = width // 2, height // 4
+        first_rect = [(x, y) for y in range(rect_height) for x in range(rect_width)]
+        second_rect = [(x + rect_width // 2, y + rect_height // 2) for x, y in first_rect]
+        def select(image = image, first_rect = first_rect, second_rect = second_rect):
+            image.set_selection(first_rect)
+            image.set_selection(second_rect, append = True)
+        def clear_selection(image = image):
+            image.set_selection()
+            image.redraw_set = set()
+            image.redraw_areas = []
+        benchmarks.append(Benchmark("set_selection/" + name, select, len(first_rect) + len(second_rect), "cells", setup = clear_selection))
+
+        # Dragging a selection rectangle open, one preliminary update per mouse move
+        drag_steps = 50
+        def drag_selection(image = image, rect_width = rect_width, rect_height = rect_height):
+            for step in range(1, drag_steps + 1):
+                image.set_selection_rect(0, 0, rect_width * step // drag_steps, rect_height * step // drag_steps, preliminary = True)
+            image.set_selection_rect(0, 0, rect_width, rect_height)
+        benchmarks.append(Benchmark("drag_selection/" + name, drag_selection, drag_steps + 1, "updates", setup = clear_selection))
+
+        # Pasting and filling the same rectangle, and undoing and redoing the paste
+        paste_buffer = [(x, y, [ord("#"), 4, 1]) for x, y in first_rect]
+        def paste(image = image, paste_buffer = paste_buffer):
+            image.paste(paste_buffer, x = 0, y = 0)
+        def select_first(image = image, first_rect = first_rect):
+            image.set_selection_rect(0, 0, rect_width, rect_height)
+        benchmarks.append(Benchmark("paste/" + name, paste, len(paste_buffer), "cells"))
+        benchmarks.append(Benchmark("fill_selection/" + name, image.fill_selection, len(first_rect), "cells", setup = select_first))
+        
+        history = AnsiUndo()
+        history.add(image.paste(paste_buffer, x = 0, y = 0))
+        def undo_redo(image = image, history = history):
+            history.undo(image)
+            history.redo(image)
+        benchmarks.append(Benchmark("undo_redo_paste/" + name, undo_redo, len(first_rect), "cells"))
+
+        # What an autosave costs the editor, writing happens in the background
+        autosave = AnsiAutosave(os.path.join(temp_dir, "autosave_" + name), steps = 1)
+        def autosave_step(image = image, autosave = autosave):
+            autosave.step(image)
+        def autosave_wait(autosave = autosave):
+            autosave.wait()
+        benchmarks.append(Benchmark("autosave_step/" + name, autosave_step, 1, "saves", setup = autosave_wait, teardown = autosave_wait))
+
+        # Lookup table transforms of the whole canvas, undone right after so every run does the same work
+        for transform_name, transform in (("deice", AnsiTransform.deice()), ("swap_colours", AnsiTransform.swap_colours())):
+            def transform_undo(image = image, transform = transform):
+                image.transform(transform).apply(image)
+            benchmarks.append(Benchmark("transform_" + transform_name + "/" + name, transform_undo, width * height, "cells"))
+
+    deice_image = random_canvas(graphics, 80, 1000)
+    original = deice_image.ansi_image.copy()
+    def restore():
+        deice_image.ansi_image[:] = original
+    benchmarks.append(Benchmark("deice/canvas_80x1000", deice_image.deice, deice_image.width * deice_image.height, "cells", setup = restore))
+    return benchmarks
+
+def palette_benchmarks(graphics):
+    """
+    The images AnsiPalette builds for the palette widgets
+    """
+    palette = AnsiPalette(graphics, os.path.join(CONFIG_DIR, "palettes.ans"))
+    def char_sequence_images():
+        for index in range(palette.char_sequence_count()):
+            palette.get_char_sequence_image(index)
+    def char_images():
+        for char_idx in range(256):
+            palette.get_char_image(char_idx)
+    return [
+        Benchmark("palette/get_palette_image", palette.get_palette_image, 1, "images"),
+        Benchmark("palette/get_character_image", palette.get_character_image, 1, "images"),
+        Benchmark("palette/get_char_sequence_image", char_sequence_images, palette.char_sequence_count(), "images"),
+        Benchmark("palette/get_char_image", char_images, 256, "images"),
+    ]
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files like http.server does, without logging every request
+    """
+    def log_message(self, format, *args):
+        pass
+
+def serve_directory(directory):
+    """
+    Serves the files in directory over HTTP on a free local port, from a background thread.
+    Returns the server and its base url.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietRequestHandler, directory = directory))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+def fetch_benchmarks(graphics, base_url):
+    """
+    RemoteFetcher downloads of every file in images/ from the local server at base_url: Whole
+    downloads, conditional requests answered from the cache, and parsing while downloading like
+    the web viewer does
+    """
+    fetcher = RemoteFetcher(max_bytes = 1024 * 1024)
+    benchmarks = []
+    for ansi_path in ansi_files():
+        name = os.path.basename(ansi_path)
+        url = base_url + name
+        with open(ansi_path, "rb") as f:
+            ansi_bytes = f.read()
+
+        # Both a fresh download and a cached one have to give the file back unchanged
+        fetcher.cache.clear()
+        if fetcher.fetch(url) != ansi_bytes or fetcher.fetch(url) != ansi_bytes:
+            raise ValueError("Fetching " + url + " did not return the file")
+
+        image = AnsiImage(graphics)
+        def parse_streamed(image = image, url = url):
+            image.parse_ans_chunks(fetcher.open(url)[1], max_width = 1024)
+        benchmarks.append(Benchmark("fetch/" + name, lambda url = url: fetcher.fetch(url), len(ansi_bytes), "bytes", setup = fetcher.cache.clear))
+        benchmarks.append(Benchmark("fetch_not_modified/" + name, lambda url = url: fetcher.fetch(url), len(ansi_bytes), "bytes", setup = lambda url = url: fetcher.fetch(url)))
+        benchmarks.append(Benchmark("fetch_parse/" + name, parse_streamed, len(ansi_bytes), "bytes", setup = fetcher.cache.clear))
+    return benchmarks
+
+def git_commit():
+    """
+    Returns the current commit hash (marked if there are uncommitted changes), or None outside of git
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = BASE_DIR, capture_output = True, text = True, check = True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd = BASE_DIR, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if changes != "":
+        commit += "-dirty"
+    return commit
+
+def format_amount(value, unit):
+    """
+    Human readable throughput or size
+    """
+    for prefix in ["", "k", "M", "G"]:
+        if abs(value) < 1000 or prefix == "G":
+            return "{0:.1f} {1}{2}".format(value, prefix, unit)
+        value /= 1000
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Benchmarks the non-Qt parts of hanse.")
+    parser.add_argument("--repeat", type = int, default = 5, help = "timed runs per benchmark, the best one counts")
+    parser.add_argument("--filter", default = None, help = "only run benchmarks with this in their name")
+    parser.add_argument("--output", default = None, help = "where to write the json results (default: benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", default = None, help = "json results of an earlier run to compare against")
+    args = parser.parse_args(argv[1:])
+
+    # Font caches and autosaves go into a temporary directory that is removed when everything has run
+    with tempfile.TemporaryDirectory(prefix = "hanse_bench_") as temp_dir:
+        font_cache_dir = os.path.join(temp_dir, "fonts")
+        graphics = AnsiGraphics(os.path.join(CONFIG_DIR, "cp866_8x16.fnt"), 8, 16, cache_dir = font_cache_dir)
+        benchmarks = font_benchmarks(font_cache_dir)
+        benchmarks += ans_benchmarks(graphics)
+        benchmarks += bitmap_benchmarks(graphics)
+        benchmarks += edit_benchmarks(graphics, temp_dir)
+        benchmarks += palette_benchmarks(graphics)
+        server, base_url = serve_directory(IMAGE_DIR)
+        benchmarks += fetch_benchmarks(graphics, base_url)
+        if args.filter != None:
+            benchmarks = [benchmark for benchmark in benchmarks if args.filter in benchmark.name]
+
+        previous = {}
+        if args.compare != None:
+            with open(args.compare, "r") as f:
+                previous = {result["name"]: result for result in json.load(f)["results"]}
+
+        results = []
+        for benchmark in benchmarks:
+            result = benchmark.measure(args.repeat)
+            results.append(result)
+
+            line = "{0:<45} {1:>10.2f} ms {2:>16}/s {3:>12} peak".format(
+                result["name"],
+                result["best_s"] * 1000.0,
+                format_amount(result["throughput"] or 0, result["unit"]),
+                format_amount(result["peak_bytes"], "B")
+            )
+            if result["name"] in previous:
+                line += " {0:>7.2f}x".format(previous[result["name"]]["best_s"] / result["best_s"])
+            print(line, flush = True)
+        server.shutdown()
+
+    commit = git_commit()
+    output_path = args.output
+    if output_path == None:
+        output_path = os.path.join(BASE_DIR, "benchmark_results", (commit or time.strftime("%Y%m%d_%H%M%S")) + ".json")
+    if os.path.dirname(output_path) != "":
+        os.makedirs(os.path.dirname(output_path), exist_ok = True)
+    with open(output_path, "w") as f:
+        json.dump({
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "results": results,
+        }, f, indent = 4)
+    print("Results written to", output_path)
+
+if __name__ == "__main__":
+    main(sys.argv)
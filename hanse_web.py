@@ -1,21 +1,35 @@
-from flask import Flask, request, send_from_directory, render_template, send_file, redirect
-from werkzeug.contrib.cache import SimpleCache
+from flask import Flask, request, send_from_directory, render_template, send_file, redirect, make_response, Response, stream_with_context
+from werkzeug.http import is_resource_modified
 
 app = Flask(__name__, static_url_path='')
-cache = SimpleCache()
 app_root = "hanseweb"
 base_path = "images/"
 
 import numpy as np
 from io import BytesIO
+import datetime
 import glob
-import requests
+import hashlib
+import html
+import os
+import zlib
 
 from AnsiGraphics import AnsiGraphics
 from AnsiImage import AnsiImage
 from AnsiPalette import AnsiPalette
+from AnsiSauce import AnsiSauce
+from RemoteFetcher import RemoteFetcher
+from WebCache import WebCache
 
-ansi_graphics = AnsiGraphics('config/cp866_8x16.fnt', 8, 16)
+# Parsed images, and encoded PNGs, keyed by what they were made from
+ansi_cache = WebCache(128 * 1024 * 1024)
+png_cache = WebCache(64 * 1024 * 1024)
+
+# Remote files, over kept-open connections and fetched again only if they changed
+remote_fetcher = RemoteFetcher(max_bytes = 200*1024)
+
+# Font tables are loaded once and shared between all worker processes
+ansi_graphics = AnsiGraphics.shared('config/cp866_8x16.fnt', 8, 16)
 
 pal_styles = ""
 for i in range(16):
@@ -28,39 +42,89 @@ for i in range(16):
     pal_entry += "}\n\n"
     pal_styles += pal_entry
 
-def get_remote_file(url, max_size = 200*1024):
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
+def gzip_stream(chunks, flush_size = 64 * 1024):
+    # Compresses as it goes, flushing what's there now and then so the client can start on it
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    unflushed = 0
+    first = True
+    for chunk in chunks:
+        chunk = chunk.encode('utf-8')
+        compressed = compressor.compress(chunk)
+        unflushed += len(chunk)
+        if first == True or unflushed >= flush_size:
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            unflushed = 0
+            first = False
+        if len(compressed) != 0:
+            yield compressed
+    yield compressor.flush()
 
-    if int(r.headers.get('Content-Length')) > max_size:
-        raise ValueError('response too large')
-
-    size = 0
-    content = b""
-    for chunk in r.iter_content(1024):
-        size += len(chunk)
-        if size > max_size:
-            raise ValueError('response too large')
-        content += chunk
-    return content
+def describe_ansi(ansi_path):
+    # Only reads the SAUCE record at the end of the file, not the whole thing
+    try:
+        sauce = AnsiSauce.read(ansi_path)
+    except:
+        sauce = None
+    if sauce == None:
+        return ""
+    return html.escape(sauce.describe())
 
-def load_ansi(path):
+def check_path(path):
     if ".." in path or path[0] == '/':
         raise(ValueError("dangerous."))
-              
+
+def remote_content(content):
+    yield content
+
+def ansi_version(path):
+    # Identifies the current contents of an ansi file: size and modification time for local
+    # files, the validator the server sent for remote ones, which are requested again (conditionally)
+    # for that. Remote files without a validator are identified by a hash of their whole contents.
+    # Returns the version, the modification time if known, and the remote contents as chunks if any,
+    # which are downloaded while they're parsed - see close_source.
+    check_path(path)
+    if path[0:4] == 'http':
+        validator, chunks = remote_fetcher.open(path)
+        if validator == None:
+            content = b"".join(chunks)
+            return hashlib.blake2b(content, digest_size = 16).hexdigest(), None, remote_content(content)
+        return ('remote', validator), None, chunks
+    stat = os.stat(base_path + path)
+    return (stat.st_mtime_ns, stat.st_size), stat.st_mtime, None
+
+def close_source(source):
+    # Stops downloading remote contents that turned out not to be needed, or that were only partly read
+    if source[2] != None:
+        source[2].close()
+
+def load_ansi(path, source = None):
+    # Parsed images are shared between requests, as read-only views, and parsed only once
+    # even when several requests ask for the same one at the same time. source is what
+    # ansi_version returned for the path, if that was already called.
+    if source == None:
+        source = ansi_version(path)
+    version, _, chunks = source
+
     wide_mode = False
     if request.args.get('wide', False) != False:
         wide_mode = True    
     
-    ansi_image = AnsiImage(ansi_graphics)
-    ansi_image.clear_image(1, 1)
-    
-    if path[0:4] == 'http':
-        ansi_data = get_remote_file(path)
-        ansi_image.parse_ans(ansi_data, wide_mode = wide_mode)
-    else:
-        ansi_image.load_ans(base_path + path, wide_mode = wide_mode)
-    return ansi_image
+    def parse():
+        ansi_image = AnsiImage(ansi_graphics)
+        ansi_image.clear_image(1, 1)
+        if chunks != None:
+            # Parsed while they download, so the width limit stops the download as well. Their SAUCE
+            # record only arrives at the end, and files it makes wider than 80 are parsed again then.
+            ansi_image.parse_ans_chunks(chunks, wide_mode = wide_mode, max_width = 1024)
+        else:
+            ansi_image.load_ans(base_path + path, wide_mode = wide_mode)
+        return ansi_image
+
+    try:
+        ansi_image = ansi_cache.get_or_load((path, version, wide_mode), parse, lambda ansi_image: ansi_image.ansi_image.nbytes)
+    finally:
+        close_source(source)
+    return ansi_image.read_only_view()
 
 @app.route('/', methods = ['GET', 'POST'])
 def file_list():
@@ -71,7 +135,8 @@ def file_list():
     list_html = '<h1>Files</h1><div style="text-align: left; font-size: 28px; width: 600px;">'
     for ansi_file in file_list:
         ansi_file = ansi_file[len(base_path):]
-        list_html += '--> <a href="/' + app_root + '/view/' + ansi_file + '">' + ansi_file + '</a><br/>'
+        description = describe_ansi(base_path + ansi_file)
+        list_html += '--> <a href="/' + app_root + '/view/' + ansi_file + '">' + ansi_file + '</a> ' + description + '<br/>'
     list_html += '<a href="/' + app_root + '/gallery">gallery</a>'
     list_html += '<form method="post" action="/' + app_root + '">url: <input type="text" name="load_url" style="width: 600px;"></input> <input type="submit" value="load"></input></form></div>'
     return(render_template("default.html", title="files", content=list_html, app_root=app_root))
@@ -82,7 +147,8 @@ def gallery():
     list_html = '<h1>Gallery</h1><div style="text-align: left; font-size: 28px;" class="gallery">'
     for ansi_file in file_list:
         ansi_file = ansi_file[len(base_path):]
-        list_html += '<a href="/' + app_root + '/view/' + ansi_file + '"><img src="/' + app_root + '/image/' + ansi_file + '?thumb"></img></a>'
+        description = describe_ansi(base_path + ansi_file)
+        list_html += '<a href="/' + app_root + '/view/' + ansi_file + '" title="' + description + '"><img src="/' + app_root + '/image/' + ansi_file + '?thumb"></img></a>'
     list_html += '<a href="/' + app_root + '"><-- back</a></div>'
     return(render_template("default.html", title="gallery", content=list_html, app_root=app_root))
 
@@ -92,22 +158,29 @@ def render_ansi(path):
         ansi_image = load_ansi(path)
     except:
         return(render_template("default.html", title="Loading error, sorry.", content="<h3>Loading error, sorry</h3>", app_root = app_root))
-    width, height = ansi_image.get_size()
     
-    html_ansi = ""
-    html_ansi += '<div style="text-align: left; font-size: 28px;"><a href="/' + app_root + '"><-- back</a></div>'
-    html_ansi += '<div style="display:inline-block; background:url(' + "'/" + app_root + '/image/' + path + "'" + ');">'
-    for y in range(height):
-        for x in range(width):
-            char = ansi_image.get_cell(x, y)
-            html_ansi += '<span class="fg' + str(char[1]) + ' bg' + str(char[2]) + '">'
-            if char[0] < 32:
-                char[0] = 32
-            html_ansi += chr(char[0])
-            html_ansi += '</span>'
-        html_ansi += "\n"
-    html_ansi += '</div>'
-    return(render_template("default.html", title=path, styles=pal_styles, content=html_ansi, show_dl=True, app_root=app_root))
+    html_start = '<div style="text-align: left; font-size: 28px;"><a href="/' + app_root + '"><-- back</a></div>'
+    html_start += '<div style="display:inline-block; background:url(' + "'/" + app_root + '/image/' + path + "'" + ');">'
+    html_end = '</div>'
+
+    # The page is rendered around a marker, then sent in pieces with the rows in between as they're made
+    content_marker = '<!-- ansi -->'
+    page = render_template("default.html", title=path, styles=pal_styles, content=content_marker, show_dl=True, app_root=app_root)
+    page_start, page_end = page.split(content_marker, 1)
+
+    def page_chunks():
+        yield page_start + html_start
+        for html_row in ansi_image.html_rows():
+            yield html_row
+        yield html_end + page_end
+
+    if 'gzip' in request.accept_encodings:
+        response = Response(stream_with_context(gzip_stream(page_chunks())), mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(stream_with_context(page_chunks()), mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/ansi/<path:path>')
 def send_ansi(path):
@@ -116,7 +189,7 @@ def send_ansi(path):
     except:
         return(render_template("default.html", title="Loading error, sorry.", content="<h3>Loading error, sorry</h3>", app_root=app_root))
     img_io = BytesIO()
-    img_io.write(ansi_image.to_ans())
+    ansi_image.write_ans(img_io)
     img_io.seek(0)
     return send_file(img_io, mimetype='plain/text')
 
@@ -124,32 +197,58 @@ def send_ansi(path):
 def render_ansi_png(path):
     transparent = False
     thumb = False
+    wide = False
     
     if request.args.get('transparent', None) != None:
         transparent = True
     if request.args.get('thumb', None) != None:
         thumb = True    
+    if request.args.get('wide', False) != False:
+        wide = True
     
-    cached = cache.get(request.url)
-    if not cached is None:
-        bitmap = cached
+    try:
+        source = ansi_version(path)
+        version, modified_time, _ = source
+    except:
+        return(render_template("default.html", title="Loading error, sorry.", content="<h3>Loading error, sorry</h3>", app_root=app_root))
+
+    # The validators follow from what the image is rendered from, so a client that has it
+    # already gets its 304 without anything being rendered or encoded
+    cache_key = (path, version, transparent, thumb, wide)
+    etag = hashlib.blake2b(repr(cache_key).encode('utf-8'), digest_size = 16).hexdigest()
+    last_modified = None
+    if modified_time != None:
+        last_modified = datetime.datetime.fromtimestamp(int(modified_time), datetime.timezone.utc)
+    if not is_resource_modified(request.environ, etag = etag, last_modified = last_modified):
+        close_source(source)
+        response = make_response('', 304)
     else:
-        try:
-            ansi_image = load_ansi(path)
-        except:
-            return(render_template("default.html", title="Loading error, sorry.", content="<h3>Loading error, sorry</h3>", app_root=app_root))
-
-        bitmap = ansi_image.to_bitmap(transparent = transparent)
-        if thumb == True:
-            bitmap.thumbnail((256, 256))
-        cache.set(request.url, bitmap)
-        
-    img_io = BytesIO()
-    bitmap.save(img_io, 'PNG')
-    img_io.seek(0)
-    
-    return send_file(img_io, mimetype='image/png')
-   
+        png_bytes = png_cache.get(cache_key)
+        if png_bytes is not None:
+            close_source(source)
+        if png_bytes is None:
+            try:
+                ansi_image = load_ansi(path, source)
+            except:
+                return(render_template("default.html", title="Loading error, sorry.", content="<h3>Loading error, sorry</h3>", app_root=app_root))
+
+            if thumb == True:
+                bitmap = ansi_image.to_thumbnail(256, 256, transparent = transparent)
+            else:
+                bitmap = ansi_image.to_bitmap(transparent = transparent)
+            img_io = BytesIO()
+            bitmap.save(img_io, 'PNG')
+            png_bytes = img_io.getvalue()
+            png_cache.set(cache_key, png_bytes)
+        response = make_response(png_bytes)
+        response.mimetype = 'image/png'
+
+    response.set_etag(etag)
+    if last_modified != None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/webfont/<path:path>')
 def webfont(path):
     return send_from_directory('webfont', path)